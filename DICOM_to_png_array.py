@@ -3,219 +3,342 @@ import os
 from PIL import Image
 import numpy as np
 import cv2
+from windowing import apply_windows
+from slice_index import build_slice_index, slice_file_name, study_number_from_path
+from profiling import profiled, record, file_size
+from pipeline_logging import record_error
+from slice_cache import cached_slice
+from prefetch import prefetch, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+from resize_engine import resize_slice, DEFAULT_SIZE, IMAGE_INTERPOLATION, MASK_INTERPOLATION
+import logging
 
+logger = logging.getLogger(__name__)
 
-def dicom_to_png_array(dicom_path, png_path):
+
+def dicom_to_png_array(dicom_path, png_path, window='soft_tissue'):
     """
     Преобразует DICOM-файл в массив png файлов с применением окна для мягких тканей.
 
     :param dicom_path: Путь к DICOM-файлу.
     :param png_path: Путь для сохранения PNG-изображения.
-    :param rescale: Изменить размер изображения.
+    :param window: Имя окна из WINDOW_PRESETS или кортеж (центр, ширина), по умолчанию - мягкие ткани.
     """
     try:
         ds = pydicom.dcmread(dicom_path)
-        pixel_array = ds.pixel_array.astype(float)
+        pixel_array = ds.pixel_array
 
-        # Применение рескейлинга (по DICOM-файлу)
+        # Рескейлинг (по DICOM-файлу) учитывается при применении окна
+        rescale_slope, rescale_intercept = 1.0, 0.0
         if 'RescaleSlope' in ds and 'RescaleIntercept' in ds:
             rescale_slope = float(ds.RescaleSlope)
             rescale_intercept = float(ds.RescaleIntercept)
-            pixel_array = pixel_array * rescale_slope + rescale_intercept
-
-        # Настройки Soft Tissue Window
-        soft_tissue_center = 10  # Центр окна для мягких тканей
-        soft_tissue_width = 350  # Ширина окна для мягких тканей
 
-        # Применение окна для мягких тканей в [0, 255]
-        img_min = soft_tissue_center - soft_tissue_width / 2
-        img_max = soft_tissue_center + soft_tissue_width / 2
-        windowed_image = np.clip(pixel_array, img_min, img_max)
-        windowed_image = ((windowed_image - img_min) / (img_max - img_min) * 255).astype(np.uint8)
+        # Применение окна в [0, 255]
+        windowed_image = apply_windows(pixel_array, {'window': window}, rescale_slope, rescale_intercept)['window']
 
-        image = np.array(windowed_image)
-        image = Image.fromarray(image)
+        image = Image.fromarray(windowed_image)
 
         # Сохранение изображения в формате PNG
         image.save(png_path, format="PNG")
-        print(f"Файл успешно сохранен как {png_path}")
+        logger.debug("Файл успешно сохранен как %s", png_path)
 
     except Exception as e:
-        print(f"Ошибка при преобразовании DICOM в PNG: {e}")
+        record_error('dicom_to_png_array', dicom_path, e)
 
 
-def png_to_png(input_png_path, input_png_segmentation_path, output_path, resize=True):
-    '''
-    Преобразует PNG-файл в PNG с окном для мягких тканей (Soft Tissue Window).
-    Если нет размеченного изображения, то обрезает изображение по контурам.
-    Если есть размеченное изображение, то обрезает его также, как и основное без разметки.
-    :param original_path: Путь к оригинальному PNG-файлу.
-    :param segmentation_path: Путь к размеченному PNG-файлу.
-    :param png_path: Путь для сохранения PNG-изображения.
-    :param resize: Изменить размер изображения.
-    '''
-    if input_png_segmentation_path == "":
-        try:
-            img = Image.open(input_png_path, mode='r', formats=None)
+def rgb_to_gray(images):
+    """
+    Векторный перевод RGB(A) в оттенки серого для массива любой формы (..., 3/4).
+    Использует те же целочисленные коэффициенты, что и cv2.COLOR_RGB2GRAY.
+    """
+    red = images[..., 0].astype(np.uint32)
+    green = images[..., 1].astype(np.uint32)
+    blue = images[..., 2].astype(np.uint32)
+    return ((red * 4899 + green * 9617 + blue * 1868 + 8192) >> 14).astype(np.uint8)
+
+
+@profiled('compute_crop_box')
+def compute_crop_box(images, chunk_size=32):
+    """
+    Вычисляет один общий прямоугольник обрезки для всех срезов исследования: объединение пикселей,
+    которые не являются ни черными, ни белыми, за одну редукцию по объему (по частям из chunk_size срезов).
 
-            pixel_array = np.array(img)
-            # print(pixel_array.shape)
+    :param images: Список или массив срезов одного размера (H, W) или (H, W, 3/4).
+    :param chunk_size: Количество срезов, обрабатываемых за один векторный шаг.
+    :return: Кортеж (x, y, w, h), как у cv2.boundingRect.
+    """
+    union = None
+    for start in range(0, len(images), chunk_size):
+        chunk = np.stack(images[start:start + chunk_size])
+        if chunk.ndim == 4:
+            chunk = rgb_to_gray(chunk)
 
-            image = np.array(pixel_array)
+        # Маска пикселей, которые не являются ни черными (0), ни белыми (255)
+        chunk_mask = ((chunk >= 1) & (chunk <= 254)).any(axis=0)
+        union = chunk_mask if union is None else union | chunk_mask
 
-            # Удаление верхней части изображения и левой части (закрашивание в черный)
-            image[:19, :] = (0, 0, 0, 255)  # Верхняя часть
-            image[:, :19] = (0, 0, 0, 255)  # Левая часть
+    if union is None:
+        raise ValueError("Нет срезов для вычисления области обрезки.")
 
-            mask_image = image
-            if len(image.shape) > 2:
-                mask_image = cv2.cvtColor(mask_image, cv2.COLOR_RGB2GRAY)
+    # Верхняя и левая части изображения закрашиваются в черный и не учитываются
+    union[:19, :] = False
+    union[:, :19] = False
 
-            # Создание маски для пикселей, которые не являются ни черными, ни белыми
-            lower_threshold = 1  # Минимальное значение (исключаем черный)
-            upper_threshold = 254  # Максимальное значение (исключаем белый)
-            mask_image = cv2.inRange(mask_image, lower_threshold, upper_threshold)
+    rows = np.flatnonzero(union.any(axis=1))
+    columns = np.flatnonzero(union.any(axis=0))
+    if rows.size == 0:
+        raise ValueError("На срезах нет пикселей, отличных от черного и белого.")
 
-            # Применение маски для получения координат "ненулевых" пикселей
-            non_zero = cv2.findNonZero(mask_image)
+    return int(columns[0]), int(rows[0]), int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1)
 
-            # Get bounding rectangle
-            x, y, w, h = cv2.boundingRect(non_zero)
 
-            print(x, y, w, h)
+def compute_study_crop_box(input_dir):
+    """
+    Вычисляет общий прямоугольник обрезки (compute_crop_box) по всем PNG-файлам директории исследования.
 
-            # Convert back to PIL and crop
-            image = Image.fromarray(image[y:y + h, x:x + w])
+    :param input_dir: Директория с PNG-файлами исследования.
+    :return: Кортеж (x, y, w, h).
+    """
+    return compute_crop_box([load_source_slice(os.path.join(input_dir, f))[0] for f in build_slice_index(input_dir)])
 
-            if resize:
-                image = image.resize((512, 512))  # 384
-                image = np.array(image)
-                image = Image.fromarray(image)
 
-            image.save(output_path, format="PNG")
-            print(f"Файл успешно сохранен как {output_path}")
+def blackout_slice(image):
+    """
+    Возвращает копию среза с закрашенными в черный верхней и левой частями.
+    """
+    image = np.array(image)
 
-        except Exception as e:
-            print(f"Ошибка при преобразовании PNG в PNG: {e}")
-    else:
-        try:
-            img = Image.open(input_png_path, mode='r', formats=None)
-            img_seg = Image.open(input_png_segmentation_path, mode='r', formats=None)
+    # Удаление верхней части изображения и левой части (закрашивание в черный)
+    image[:19, :] = (0, 0, 0, 255)  # Верхняя часть
+    image[:, :19] = (0, 0, 0, 255)  # Левая часть
+    return image
 
-            image = np.array(img)
-            image_seg = np.array(img_seg)
 
-            # 1) работаем только с изображением без разметки
+def slice_crop_box(image):
+    """
+    Вычисляет прямоугольник обрезки среза (x, y, w, h) по пикселям, которые не являются ни черными, ни белыми.
+    """
+    mask_image = image
+    if len(image.shape) > 2:
+        mask_image = cv2.cvtColor(mask_image, cv2.COLOR_RGB2GRAY)
 
-            if (image.shape[:2] != image_seg.shape[:2]):
-                print("Ошибка: Размеры массивов пикселей не совпадают.")
-                return
+    # Создание маски для пикселей, которые не являются ни черными, ни белыми
+    lower_threshold = 1  # Минимальное значение (исключаем черный)
+    upper_threshold = 254  # Максимальное значение (исключаем белый)
+    mask_image = cv2.inRange(mask_image, lower_threshold, upper_threshold)
 
-            # Удаление верхней части изображения И левой части
-            image[:19, :] = (0, 0, 0, 255)  # Верхняя часть
-            image[:, :19] = (0, 0, 0, 255)  # Левая часть
+    # Применение маски для получения координат "ненулевых" пикселей
+    non_zero = cv2.findNonZero(mask_image)
 
-            mask_image = image
+    # Get bounding rectangle
+    x, y, w, h = cv2.boundingRect(non_zero)
+    logger.debug("Область обрезки: x=%d, y=%d, w=%d, h=%d", x, y, w, h)
+    return x, y, w, h
 
-            if len(image.shape) > 2:
-                mask_image = cv2.cvtColor(mask_image, cv2.COLOR_RGB2GRAY)
 
-            # Создание маски для пикселей, которые не являются ни черными, ни белыми
-            lower_threshold = 1  # Минимальное значение (исключаем черный)
-            upper_threshold = 254  # Максимальное значение (исключаем белый)
-            mask_image = cv2.inRange(mask_image, lower_threshold, upper_threshold)
+def load_source_slice(path, need_crop_box=False):
+    """
+    Декодирует исходный PNG-срез и закрашивает служебные области (blackout_slice). Если включен кэш
+    исследования (slice_cache), повторные обращения к тому же файлу (проход снимков и проход разметки)
+    не декодируют и не обрабатывают срез заново.
 
-            # Применение маски для получения координат "ненулевых" пикселей
-            non_zero = cv2.findNonZero(mask_image)
+    :param path: Путь к исходному PNG-файлу.
+    :param need_crop_box: Вычислить прямоугольник обрезки среза (slice_crop_box), если его еще нет в кэше.
+    :return: Кортеж (обработанный срез только для чтения, прямоугольник обрезки или None).
+    """
+    def load():
+        # Прочитанный объем учитывается только при реальном чтении файла, а не при попадании в кэш
+        record('decode', bytes_read=file_size(path), slices=1)
+        image = blackout_slice(Image.open(path, mode='r', formats=None))
+        image.flags.writeable = False
+        return [image, None]
 
-            x, y, w, h = cv2.boundingRect(non_zero)
+    entry = cached_slice(os.path.abspath(path), load)
+    if need_crop_box and entry[1] is None:
+        entry[1] = slice_crop_box(entry[0])
+    return entry[0], entry[1]
 
-            image = Image.fromarray(image[y:y + h, x:x + w, :])
 
-            # Ресайз изображения
-            if resize:
-                image = image.resize((512, 512))  # 384
-                image = np.array(image)
-                image = Image.fromarray(image)
+def crop_png_arrays(image, image_seg=None, resize=True, crop_box=None, size=DEFAULT_SIZE, return_box=False):
+    '''
+    Обрезает изображение по контурам (пикселям, которые не являются ни черными, ни белыми).
+    Если передано размеченное изображение, то обрезает его также, как и основное без разметки.
+    :param image: Массив пикселей изображения без разметки (RGBA).
+    :param image_seg: Массив пикселей размеченного изображения или None.
+    :param resize: Изменить размер изображения.
+    :param crop_box: Готовый прямоугольник (x, y, w, h), например общий для исследования (compute_crop_box);
+        если не задан, вычисляется по самому срезу.
+    :param size: Размер стороны среза после изменения размера (512 или 384).
+    :param return_box: Добавить к результату использованный прямоугольник обрезки (для slice_transforms).
+    :return: Кортеж (обрезанное изображение, обрезанное размеченное изображение или None[, прямоугольник]).
+    '''
+    if image_seg is not None and image.shape[:2] != image_seg.shape[:2]:
+        raise ValueError("Размеры массивов пикселей не совпадают.")
+
+    image = blackout_slice(image)
+    if crop_box is None:
+        crop_box = slice_crop_box(image)
+
+    if return_box:
+        return crop_prepared_arrays(image, crop_box, image_seg, resize, size) + (tuple(crop_box),)
+    return crop_prepared_arrays(image, crop_box, image_seg, resize, size)
+
+
+def crop_prepared_arrays(image, crop_box, image_seg=None, resize=True, size=DEFAULT_SIZE):
+    '''
+    Обрезает подготовленный срез (blackout_slice) и, если передано, размеченное изображение по прямоугольнику
+    crop_box и приводит их к размеру size x size (resize_engine): снимок - интерполяцией по площади,
+    разметка - ближайшим соседом, чтобы цвета контуров не смешивались.
+    :return: Кортеж (обрезанное изображение, обрезанное размеченное изображение или None).
+    '''
+    x, y, w, h = crop_box
+
+    image = image[y:y + h, x:x + w]
+    image = resize_slice(image, size, IMAGE_INTERPOLATION) if resize else image.copy()
+
+    if image_seg is None:
+        return image, None
 
-            # 2) аналогичные преобразования для размеченного изображения
+    # Аналогичные преобразования для размеченного изображения
+    seg_image = image_seg[y:y + h, x:x + w]
+    seg_image = resize_slice(seg_image, size, MASK_INTERPOLATION) if resize else seg_image.copy()
+
+    return image, seg_image
+
+
+def read_png_pair(input_png_path, input_png_segmentation_path, need_crop_box=True):
+    '''
+    Читает исходный срез (load_source_slice) и, если задан путь, размеченное изображение.
+    Используется как функция чтения для предвыборки (prefetch).
+    :return: Кортеж (подготовленный срез, его прямоугольник обрезки или None, размеченное изображение или None).
+    '''
+    source, source_box = load_source_slice(input_png_path, need_crop_box=need_crop_box)
+    img_seg = None
+    if input_png_segmentation_path != "":
+        record('decode', bytes_read=file_size(input_png_segmentation_path), slices=1)
+        img_seg = np.array(Image.open(input_png_segmentation_path, mode='r', formats=None))
+    return source, source_box, img_seg
+
+
+def png_to_png(input_png_path, input_png_segmentation_path, output_path, resize=True, crop_box=None, loaded=None,
+               size=DEFAULT_SIZE):
+    '''
+    Преобразует PNG-файл в PNG с окном для мягких тканей (Soft Tissue Window).
+    Если нет размеченного изображения, то обрезает изображение по контурам.
+    Если есть размеченное изображение, то обрезает его также, как и основное без разметки.
+    :param original_path: Путь к оригинальному PNG-файлу.
+    :param segmentation_path: Путь к размеченному PNG-файлу.
+    :param png_path: Путь для сохранения PNG-изображения.
+    :param resize: Изменить размер изображения.
+    :param crop_box: Общий прямоугольник обрезки (x, y, w, h) или None - обрезка по самому срезу.
+    :param loaded: Заранее прочитанные данные (read_png_pair), например из предвыборки.
+    :param size: Размер стороны среза после изменения размера.
+    :return: Использованный прямоугольник обрезки (x, y, w, h) или None при ошибке.
+    '''
+    if input_png_segmentation_path == "":
+        try:
+            if loaded is None:
+                loaded = read_png_pair(input_png_path, "", need_crop_box=crop_box is None)
+            source, source_box, _ = loaded
 
-            cropped_seg_image = image_seg[y:y + h, x:x + w, :]
+            image, _ = crop_prepared_arrays(source, crop_box or source_box, resize=resize, size=size)
 
-            seg_image = Image.fromarray(cropped_seg_image)
+            Image.fromarray(image).save(output_path, format="PNG")
+            logger.debug("Файл успешно сохранен как %s", output_path)
+            return tuple(crop_box or source_box)
 
+        except Exception as e:
+            record_error('png_to_png', input_png_path, e)
+    else:
+        try:
+            if loaded is None:
+                loaded = read_png_pair(input_png_path, input_png_segmentation_path, need_crop_box=crop_box is None)
+            source, source_box, img_seg = loaded
+            if source.shape[:2] != img_seg.shape[:2]:
+                raise ValueError("Размеры массивов пикселей не совпадают.")
+
+            # Снимок здесь не нужен, поэтому изменяется размер только разметки
+            x, y, w, h = crop_box or source_box
+            seg_image = img_seg[y:y + h, x:x + w]
             if resize:
-                seg_image = seg_image.resize((512, 512))  # 384
-                seg_image = np.array(seg_image)
-                seg_image = Image.fromarray(seg_image)
+                seg_image = resize_slice(seg_image, size, MASK_INTERPOLATION)
 
-            seg_image.save(output_path, format="PNG")
-            print(f"222 Файл успешно сохранен как {output_path}")
+            Image.fromarray(seg_image).save(output_path, format="PNG")
+            logger.debug("Размеченный файл успешно сохранен как %s", output_path)
+            return tuple(crop_box or source_box)
 
         except Exception as e:
-            print(f"222 Ошибка при преобразовании DICOM в PNG: {e}")
+            record_error('png_to_png', input_png_segmentation_path, e)
 
 
-def png_to_png_directory(input_dir, input_dir_segmentation, output_dir):
+@profiled('png_to_png_directory')
+def png_to_png_directory(input_dir, input_dir_segmentation, output_dir, crop_box=None, workers=DEFAULT_WORKERS,
+                         queue_depth=DEFAULT_QUEUE_DEPTH, size=DEFAULT_SIZE):
     """
     Преобразует все PNG-файлы из input_dir в PNG и сохраняет их в output_dir.
+    Следующие срезы читаются в пуле потоков (prefetch), пока обрабатывается текущий.
 
     :param input_dir: Директория с PNG-файлами.
     :param output_dir: Директория для сохранения PNG-изображений.
+    :param crop_box: Общий прямоугольник обрезки (x, y, w, h) или None - обрезка каждого среза отдельно.
+    :param workers: Количество потоков чтения (0 - без предвыборки).
+    :param queue_depth: Количество срезов, читаемых впрок.
+    :param size: Размер стороны выходных срезов.
+    :return: Список прямоугольников обрезки (x, y, w, h) по срезам (None для срезов с ошибкой).
     """
 
     # Создание выходной директории, если она не существует
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    # Выходные файлы именуются по номеру среза: <номер исследования>_<номер среза>.png
+    study_number = study_number_from_path(input_dir)
+
     # Если есть размеченные изображения, то обрабатываем пары файлов
     if input_dir_segmentation != "":
 
-        # Получение списка файлов из обеих директорий
-        original_files = sorted([f for f in os.listdir(input_dir) if f.endswith(".png")])
-        segmentation_files = sorted([f for f in os.listdir(input_dir_segmentation) if f.endswith(".png")])
+        # Получение списка файлов из обеих директорий в порядке срезов
+        original_files = build_slice_index(input_dir)
+        segmentation_files = build_slice_index(input_dir_segmentation)
 
-        print(original_files)
-        print(segmentation_files)
+        logger.debug("png_to_png_directory: %d снимков в %s, %d размеченных в %s", len(original_files), input_dir,
+                     len(segmentation_files), input_dir_segmentation)
 
         # Определяем минимальное количество файлов
         min_files = min(len(original_files), len(segmentation_files))
 
         if min_files == 0:
-            print("Ошибка: Нет совпадающих DICOM-файлов в директориях.")
-            return
-
-        # Обрабатываем пары файлов по порядку
-        for i in range(min_files):
-            original_filename = original_files[i]
-            segmentation_filename = segmentation_files[i]
+            record_error('png_to_png_directory', input_dir, "Нет совпадающих PNG-файлов в директориях.")
+            return []
 
-            # Формируем пути
-            original_path = os.path.join(input_dir, original_filename)
-            segmentation_path = os.path.join(input_dir_segmentation, segmentation_filename)
+        # Формируем пути пар файлов по порядку (лишние файлы одной из директорий не обрабатываются)
+        pairs = [(os.path.join(input_dir, original_file), os.path.join(input_dir_segmentation, segmentation_file))
+                 for original_file, segmentation_file in zip(original_files, segmentation_files)]
+    else:
+        # Если нет размеченных изображений, то обрабатываем только снимки в порядке срезов
+        pairs = [(os.path.join(input_dir, f), "") for f in build_slice_index(input_dir)]
 
-            png_path = os.path.join(output_dir, segmentation_filename)
+    def load(pair):
+        return read_png_pair(pair[0], pair[1], need_crop_box=crop_box is None)
 
-            # Обрабатываем оба файла
-            png_to_png(original_path, segmentation_path, png_path)
+    # Обрабатываем файлы по порядку, следующие срезы читаются заранее
+    crop_boxes = []
+    for i, (pair, loaded, error) in enumerate(prefetch(pairs, load, workers, queue_depth)):
+        original_path, segmentation_path = pair
+        png_path = os.path.join(output_dir, slice_file_name(study_number, i))
 
-            print(f"Обработана пара: {original_filename} <-> {segmentation_filename}")
-    else:
-        # Если нет размеченных изображений, то обрабатываем этим путем
-        # Получение списка файлов из обеих директорий
-        original_files = [f for f in os.listdir(input_dir) if f.endswith(".png")]
+        if error is not None:
+            record_error('png_to_png', segmentation_path or original_path, error)
+            crop_boxes.append(None)
+            continue
 
-        # Обрабатываем пары файлов по порядку
-        for original_filename in original_files:
-            # Формируем пути
-            dicom_path = os.path.join(input_dir, original_filename)
+        crop_boxes.append(png_to_png(original_path, segmentation_path, png_path, crop_box=crop_box, loaded=loaded,
+                                     size=size))
+        record('png_to_png_directory', bytes_written=file_size(png_path), slices=1)
 
-            # Создаем имена для PNG-файлов
-            png_path = os.path.join(output_dir, original_filename)
+        logger.debug("Обработан файл: %s %s", os.path.basename(original_path), os.path.basename(segmentation_path))
 
-            # Обрабатываем оба файла
-            png_to_png(dicom_path, "", png_path)
-            print(f"Обработан файл: {original_filename}")
+    return crop_boxes
 
 
 if __name__ == "__main__":
@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+import socket
+import os
+
+
+@contextmanager
+def atomic_write_path(path):
+    """
+    Контекстный менеджер для атомарной записи файла: данные пишутся во временный файл в той же директории,
+    который после успешной записи заменяет path (os.replace). При ошибке временный файл удаляется,
+    поэтому другие процессы и узлы никогда не видят недописанный файл.
+    Временный файл сохраняет расширение path (nibabel определяет формат по расширению).
+
+    :param path: Путь к итоговому файлу.
+    :return: Путь к временному файлу.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f".tmp-{socket.gethostname()}-{os.getpid()}-{name}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,404 @@
+from png_mask_creator import create_binary_mask, create_binary_mask_volume, mask_to_polygons, LOWER_HSV, UPPER_HSV
+from DICOM_to_png_array import dicom_to_png_array, png_to_png
+from png_array_to_nii import save_png_to_nifty
+from dataset_creator import create_nifty_data
+from slice_index import build_slice_index
+from resize_engine import resize_stack, interpolation_flag, IMAGE_INTERPOLATION, MASK_INTERPOLATION
+from slice_transforms import make_transform_record, restore_volume
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+from PIL import Image
+import numpy as np
+import platform
+import argparse
+import tempfile
+import json
+import time
+import cv2
+import os
+
+
+def synthetic_overlays(num_slices=64, size=512, seed=0):
+    """
+    Создает набор синтетических размеченных срезов (BGR): серый "КТ"-фон и цветные пятна разметки
+    из небольшой палитры, как на реальных оверлеях.
+
+    :param num_slices: Количество срезов.
+    :param size: Размер среза в пикселях.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: numpy array uint8 формы (num_slices, size, size, 3).
+    """
+    rng = np.random.default_rng(seed)
+    gray = rng.integers(0, 256, size=(num_slices, size, size), dtype=np.uint8)
+    volume = np.repeat(gray[..., None], 3, axis=-1)
+
+    palette = [(0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255)]
+    for k in range(num_slices):
+        for _ in range(3):
+            x, y = rng.integers(0, size - size // 8, size=2)
+            radius = int(rng.integers(size // 32, size // 16))
+            colour = palette[int(rng.integers(0, len(palette)))]
+            cv2.circle(volume[k], (int(x), int(y)), radius, colour, thickness=2)
+
+    return volume
+
+
+def benchmark_binary_mask(dir_masks=None, lower_hsv=LOWER_HSV, upper_hsv=UPPER_HSV, repeats=3):
+    """
+    Сравнивает текущий пофайловый путь create_binary_mask (чтение, HSV, inRange, запись)
+    и бинаризацию уже прочитанного объема (create_binary_mask_volume) без чтения и записи файлов.
+
+    :param dir_masks: Директория с размеченными PNG; если не указана - используются синтетические срезы.
+    :param lower_hsv: Нижняя граница HSV.
+    :param upper_hsv: Верхняя граница HSV.
+    :param repeats: Количество повторов (берется лучшее время).
+    :return: Словарь с временами в секундах.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if dir_masks is None:
+            dir_masks = os.path.join(tmp_dir, "masks")
+            os.makedirs(dir_masks)
+            for k, overlay in enumerate(synthetic_overlays()):
+                cv2.imwrite(os.path.join(dir_masks, f"0_{k + 1}.png"), overlay)
+
+        file_names = sorted(f for f in os.listdir(dir_masks) if f.endswith('.png'))
+        input_masks = [os.path.join(dir_masks, f) for f in file_names]
+        output_masks = [os.path.join(tmp_dir, f) for f in file_names]
+
+        per_file, per_file_compute, volume_compute = [], [], []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for input_mask, output_mask in zip(input_masks, output_masks):
+                create_binary_mask(input_mask, output_mask, lower_hsv, upper_hsv)
+            per_file.append(time.perf_counter() - start)
+
+        volume = np.stack([cv2.imread(path) for path in input_masks])
+
+        for _ in range(repeats):
+            start = time.perf_counter()
+            expected = [cv2.inRange(cv2.cvtColor(image, cv2.COLOR_BGR2HSV), lower_hsv, upper_hsv) for image in volume]
+            per_file_compute.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            binary_masks = create_binary_mask_volume(volume, lower_hsv, upper_hsv)
+            volume_compute.append(time.perf_counter() - start)
+
+        if not np.array_equal(np.stack(expected), binary_masks):
+            raise AssertionError("Маски объема не совпадают с cv2.inRange по срезам!")
+
+    return {
+        "slices": len(file_names),
+        "per_file_io": min(per_file),
+        "per_file_compute": min(per_file_compute),
+        "volume_compute": min(volume_compute),
+    }
+
+
+def synthetic_ct_volume(num_slices=32, size=512, seed=0):
+    """
+    Создает синтетический КТ-объем в HU: воздух вокруг эллипса "тела" с мягкими тканями, костями
+    и несколькими шарообразными образованиями.
+
+    :param num_slices: Количество срезов.
+    :param size: Размер среза в пикселях.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Объем int16 формы (num_slices, size, size) и список образований (z, y, x, радиус).
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:size, :size]
+    centre = size / 2
+
+    body = ((x - centre) / (size * 0.42)) ** 2 + ((y - centre) / (size * 0.32)) ** 2 <= 1
+    spine = (x - centre) ** 2 + (y - centre - size * 0.2) ** 2 <= (size * 0.05) ** 2
+
+    lesions = [(int(rng.integers(num_slices)), int(centre + rng.integers(-size // 6, size // 6)),
+                int(centre + rng.integers(-size // 4, size // 4)), int(rng.integers(size // 40, size // 16)))
+               for _ in range(3)]
+
+    volume = np.full((num_slices, size, size), -1000, dtype=np.int16)
+    for k in range(num_slices):
+        ct_slice = volume[k]
+        ct_slice[body] = 40 + rng.normal(0, 15, size=int(body.sum())).astype(np.int16)
+        ct_slice[spine] = 700
+        for z, lesion_y, lesion_x, radius in lesions:
+            slice_radius = radius ** 2 - (k - z) ** 2
+            if slice_radius > 0:
+                ct_slice[(x - lesion_x) ** 2 + (y - lesion_y) ** 2 <= slice_radius] = 80
+    return volume, lesions
+
+
+def write_synthetic_dicom_series(volume, dicom_dir, pixel_spacing=(0.7, 0.7), slice_thickness=1.5):
+    """
+    Сохраняет объем в HU как серию DICOM-файлов (один файл на срез) с рескейлингом, положением и ориентацией
+    срезов. Файлы перемешаны по именам, чтобы сортировка по ImagePositionPatient была нужна.
+
+    :param volume: Объем int16 формы (количество срезов, H, W) в HU.
+    :param dicom_dir: Директория для DICOM-файлов.
+    :param pixel_spacing: Размер пикселя в мм.
+    :param slice_thickness: Расстояние между срезами в мм.
+    """
+    os.makedirs(dicom_dir, exist_ok=True)
+    series_uid, study_uid = generate_uid(), generate_uid()
+    order = np.random.default_rng(0).permutation(len(volume))
+
+    for k, ct_slice in enumerate(volume):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        dicom_path = os.path.join(dicom_dir, f"{order[k] + 1}.dcm")
+        ds = FileDataset(dicom_path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+        ds.is_little_endian, ds.is_implicit_VR = True, False
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID, ds.SeriesInstanceUID = study_uid, series_uid
+        ds.Modality = "CT"
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(k * slice_thickness)]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.PixelSpacing = [float(pixel_spacing[0]), float(pixel_spacing[1])]
+        ds.SliceThickness = float(slice_thickness)
+        ds.Rows, ds.Columns = ct_slice.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+        ds.PixelRepresentation = 0
+        ds.RescaleSlope, ds.RescaleIntercept = 1, -1024
+        ds.PixelData = (ct_slice.astype(np.int32) + 1024).clip(0, 65535).astype(np.uint16).tobytes()
+
+        ds.save_as(dicom_path)
+
+
+def write_synthetic_png_study(directory_path, study_name, num_slices=32, size=512, seed=0):
+    """
+    Создает синтетическое исследование в формате набора данных: <номер>.2 - исходные RGBA-срезы
+    (окно мягких тканей, белые служебные поля) и <номер>.1 - те же срезы с цветной разметкой образований.
+
+    :param directory_path: Корневая директория набора данных.
+    :param study_name: Номер исследования.
+    :param num_slices: Количество срезов.
+    :param size: Размер среза в пикселях.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Пути к директориям исходных и размеченных срезов.
+    """
+    volume, lesions = synthetic_ct_volume(num_slices, size, seed)
+    windowed = np.clip((volume.astype(np.float32) - (10 - 175)) / 350 * 255, 0, 255).astype(np.uint8)
+
+    directory_path_png = os.path.join(directory_path, f"{study_name}.2")
+    directory_path_mask = os.path.join(directory_path, f"{study_name}.1")
+    os.makedirs(directory_path_png, exist_ok=True)
+    os.makedirs(directory_path_mask, exist_ok=True)
+
+    for k, gray in enumerate(windowed):
+        image = np.dstack([gray, gray, gray, np.full_like(gray, 255)])
+        image[:12, :] = 255  # Служебная полоса сверху, как на экспортированных снимках
+        annotated = image.copy()
+        for z, lesion_y, lesion_x, radius in lesions:
+            slice_radius = radius ** 2 - (k - z) ** 2
+            if slice_radius > 0:
+                cv2.circle(annotated, (lesion_x, lesion_y), int(np.sqrt(slice_radius)), (0, 255, 0, 255), -1)
+
+        file_name = f"{k + 1}.png"
+        Image.fromarray(image).save(os.path.join(directory_path_png, file_name), format="PNG")
+        Image.fromarray(annotated).save(os.path.join(directory_path_mask, file_name), format="PNG")
+
+    return directory_path_png, directory_path_mask
+
+
+def best_time(func, repeats=3):
+    """
+    Лучшее время выполнения func() из repeats запусков в секундах.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_pipeline(num_slices=32, size=512, repeats=3, seed=0):
+    """
+    Замеряет время основных функций конвейера на синтетическом исследовании.
+
+    :param num_slices: Количество срезов.
+    :param size: Размер среза в пикселях.
+    :param repeats: Количество повторов (берется лучшее время).
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Словарь {функция: {"seconds": лучшее время, "per_slice": время на срез}}.
+    """
+    results = {}
+
+    def report(name, seconds):
+        results[name] = {"seconds": seconds, "per_slice": seconds / num_slices}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dicom_dir = os.path.join(tmp_dir, "dicom")
+        volume, _ = synthetic_ct_volume(num_slices, size, seed)
+        write_synthetic_dicom_series(volume, dicom_dir)
+        directory_path_png, directory_path_mask = write_synthetic_png_study(tmp_dir, 0, num_slices, size, seed)
+
+        dicom_files = [os.path.join(dicom_dir, f) for f in os.listdir(dicom_dir)]
+        png_out = os.path.join(tmp_dir, "dicom_png")
+        os.makedirs(png_out)
+        report("dicom_to_png_array", best_time(lambda: [
+            dicom_to_png_array(path, os.path.join(png_out, os.path.basename(path) + ".png")) for path in dicom_files
+        ], repeats))
+
+        image_files = build_slice_index(directory_path_png)
+        mask_files = build_slice_index(directory_path_mask)
+        cropped_dir = os.path.join(tmp_dir, "cropped")
+        os.makedirs(cropped_dir)
+        report("png_to_png", best_time(lambda: [
+            png_to_png(os.path.join(directory_path_png, image_file), os.path.join(directory_path_mask, mask_file),
+                       os.path.join(cropped_dir, mask_file))
+            for image_file, mask_file in zip(image_files, mask_files)
+        ], repeats))
+
+        bin_dir = os.path.join(tmp_dir, "bin")
+        os.makedirs(bin_dir)
+        report("create_binary_mask", best_time(lambda: [
+            create_binary_mask(os.path.join(cropped_dir, f), os.path.join(bin_dir, f), LOWER_HSV, UPPER_HSV)
+            for f in mask_files
+        ], repeats))
+
+        bin_masks = [cv2.imread(os.path.join(bin_dir, f), cv2.IMREAD_GRAYSCALE) for f in mask_files]
+        report("mask_to_polygons", best_time(lambda: [mask_to_polygons(mask) for mask in bin_masks], repeats))
+
+        report("save_png_to_nifty", best_time(
+            lambda: save_png_to_nifty(bin_dir, os.path.join(tmp_dir, "bin.nii.gz")), repeats))
+
+        for directory in ("images", "labels"):
+            os.makedirs(os.path.join(tmp_dir, directory), exist_ok=True)
+        for in_memory in (False, True):
+            name = "create_nifty_data_in_memory" if in_memory else "create_nifty_data"
+            report(name, best_time(lambda: create_nifty_data(tmp_dir, directory_path_png, directory_path_mask,
+                                                             in_memory=in_memory, use_cache=False), repeats))
+
+    return results
+
+
+def benchmark_resize(num_slices=64, crops=((420, 380), (900, 860)), sizes=(512, 384), repeats=3, seed=0):
+    """
+    Сравнивает изменение размера обрезанных срезов по одному через PIL Image.resize (фильтр по умолчанию)
+    и через resize_engine.resize_stack для снимков и для цветной разметки; для снимков также замеряется
+    cv2.resize по одному срезу. Размеры обрезки выбраны так, чтобы были и увеличение, и уменьшение
+    с нецелым коэффициентом (cv2.INTER_AREA).
+
+    :param num_slices: Количество срезов.
+    :param crops: Размеры обрезанного среза (h, w).
+    :param sizes: Размеры стороны после изменения размера.
+    :param repeats: Количество повторов (берется лучшее время).
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Словарь {"<h>x<w>-><размер>": {путь: время в секундах}} с ускорением относительно PIL (speedup_*)
+        и количеством цветов разметки после изменения размера (смешивание цветов контуров добавляет новые цвета).
+    """
+    source_size = max(max(crop) for crop in crops)
+    # Окно мягких тканей (центр 40, ширина 400) для синтетического объема в HU
+    volume = np.clip(synthetic_ct_volume(num_slices, source_size, seed)[0].astype(np.int32), -160, 240)
+    source_images = ((volume + 160) * 255 // 400).astype(np.uint8)
+    source_overlays = synthetic_overlays(num_slices, source_size, seed)[..., ::-1]
+
+    def colours(slice_):
+        return len(np.unique(slice_.reshape(-1, slice_.shape[-1]), axis=0))
+
+    results = {}
+    for height, width in crops:
+        images = np.ascontiguousarray(source_images[:, :height, :width])
+        overlays = np.ascontiguousarray(source_overlays[:, :height, :width])
+        for size in sizes:
+            flag = interpolation_flag(IMAGE_INTERPOLATION, (height, width), size)
+            timings = {
+                "pil_images": best_time(lambda: [np.array(Image.fromarray(image).resize((size, size)))
+                                                 for image in images], repeats),
+                "cv2_per_slice_images": best_time(lambda: [cv2.resize(image, (size, size), interpolation=flag)
+                                                           for image in images], repeats),
+                "engine_images": best_time(lambda: resize_stack(images, size, IMAGE_INTERPOLATION), repeats),
+                "pil_overlays": best_time(lambda: [np.array(Image.fromarray(overlay).resize((size, size)))
+                                                   for overlay in overlays], repeats),
+                "engine_overlays": best_time(lambda: resize_stack(overlays, size, MASK_INTERPOLATION), repeats),
+            }
+            results[f"{height}x{width}->{size}"] = dict(
+                timings,
+                # Отношение времени PIL к времени resize_engine: меньше 1 - resize_engine медленнее
+                speedup_images=timings["pil_images"] / timings["engine_images"],
+                speedup_overlays=timings["pil_overlays"] / timings["engine_overlays"],
+                source_colours=colours(overlays[0]),
+                pil_colours=colours(np.array(Image.fromarray(overlays[0]).resize((size, size)))),
+                engine_colours=colours(resize_stack(overlays[:1], size, MASK_INTERPOLATION)[0]),
+            )
+    return results
+
+
+def check_restore_round_trip(num_slices=16, source_shape=(600, 560), size=512, repeats=3, seed=0):
+    """
+    Проверяет обратное преобразование масок: случайная маска обрезается по случайному прямоугольнику
+    (не больше size, то есть с увеличением), приводится к size x size через resize_engine (cv2.INTER_NEAREST)
+    и возвращается restore_volume; результат должен точно совпасть с исходной маской внутри прямоугольника.
+
+    :return: Словарь с количеством срезов и временем restore_volume в секундах.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = source_shape
+    masks = (rng.random((num_slices, height, width)) > 0.5).astype(np.uint8)
+
+    crop_boxes, resized = [], []
+    for mask in masks:
+        w, h = int(rng.integers(size // 4, size + 1)), int(rng.integers(size // 4, size + 1))
+        x, y = int(rng.integers(0, width - w + 1)), int(rng.integers(0, height - h + 1))
+        crop_boxes.append((x, y, w, h))
+        resized.append(resize_stack(mask[None, y:y + h, x:x + w], size, MASK_INTERPOLATION)[0])
+
+    record = make_transform_record(crop_boxes, source_shape, size)
+    restored = restore_volume(np.stack(resized), record, interpolation="nearest")
+
+    expected = np.zeros_like(masks)
+    for k, (x, y, w, h) in enumerate(crop_boxes):
+        expected[k, y:y + h, x:x + w] = masks[k, y:y + h, x:x + w]
+    if not np.array_equal(restored, expected):
+        raise AssertionError("Восстановленные маски не совпадают с исходными!")
+
+    return {
+        "slices": num_slices,
+        "restore_volume": best_time(lambda: restore_volume(np.stack(resized), record, interpolation="nearest"),
+                                    repeats),
+    }
+
+
+def environment_info():
+    """
+    Сведения об окружении, необходимые для сравнения результатов разных запусков.
+    """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера на синтетических исследованиях")
+    parser.add_argument("--slices", type=int, default=32, help="Количество срезов")
+    parser.add_argument("--size", type=int, default=512, help="Размер среза в пикселях")
+    parser.add_argument("--repeats", type=int, default=3, help="Количество повторов")
+    parser.add_argument("--output", default=None, help="Путь к JSON-файлу с результатами")
+    args = parser.parse_args()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": environment_info(),
+        "params": {"slices": args.slices, "size": args.size, "repeats": args.repeats},
+        "pipeline": benchmark_pipeline(args.slices, args.size, args.repeats),
+        "binary_mask": benchmark_binary_mask(repeats=args.repeats),
+        "resize": benchmark_resize(repeats=args.repeats),
+        "restore_round_trip": check_restore_round_trip(repeats=args.repeats),
+    }
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
@@ -0,0 +1,122 @@
+from atomic_io import atomic_write_path
+import hashlib
+import json
+import os
+
+# Версия конвейера: увеличивается при изменениях, после которых старые NIfTI-файлы нужно пересобрать
+PIPELINE_VERSION = 2
+
+CACHE_DIR_NAME = ".cache"
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Вычисляет SHA-1 содержимого файла.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_fingerprint(directory, extensions=('.png', '.dcm'), hash_contents=False):
+    """
+    Вычисляет отпечаток входной директории исследования.
+
+    :param directory: Директория с исходными файлами.
+    :param extensions: Учитываемые расширения файлов.
+    :param hash_contents: Хэшировать содержимое файлов (медленнее, но не зависит от времени изменения).
+    :return: Строка SHA-1 по списку (имя, размер, время изменения или хэш содержимого).
+    """
+    digest = hashlib.sha1()
+    for name in sorted(f for f in os.listdir(directory) if f.endswith(extensions)):
+        path = os.path.join(directory, name)
+        if hash_contents:
+            entry = f"{name}:{file_digest(path)}"
+        else:
+            stat = os.stat(path)
+            entry = f"{name}:{stat.st_size}:{stat.st_mtime_ns}"
+        digest.update(entry.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def study_fingerprint(input_dirs, params, hash_contents=False):
+    """
+    Отпечаток исследования: входные директории и параметры конвейера (границы HSV, окно, размер, обрезка и т.д.).
+
+    :param input_dirs: Список входных директорий исследования.
+    :param params: Словарь параметров конвейера (значения должны сериализоваться в JSON).
+    :param hash_contents: Хэшировать содержимое файлов.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps({"version": PIPELINE_VERSION, "params": params}, sort_keys=True, default=str)
+                  .encode("utf-8"))
+    for directory in input_dirs:
+        digest.update(directory_fingerprint(directory, hash_contents=hash_contents).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def manifest_path(directory_path, study_number):
+    """
+    Путь к файлу манифеста исследования: <directory_path>/.cache/<номер исследования>.json.
+    Отдельный файл на исследование позволяет обновлять манифест из параллельных процессов.
+    """
+    return os.path.join(directory_path, CACHE_DIR_NAME, f"{study_number}.json")
+
+
+def output_state(path):
+    """
+    Размер и время изменения выходного файла (None, если файла нет).
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def is_up_to_date(manifest_file, fingerprint, outputs):
+    """
+    Проверяет, что выходные файлы исследования собраны из тех же входных данных с теми же параметрами
+    и не изменялись после сборки.
+
+    :param manifest_file: Путь к манифесту исследования.
+    :param fingerprint: Текущий отпечаток исследования (study_fingerprint).
+    :param outputs: Список путей к выходным файлам.
+    """
+    if not os.path.exists(manifest_file):
+        return False
+
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if manifest.get("fingerprint") != fingerprint:
+        return False
+
+    recorded = manifest.get("outputs", {})
+    return all(path in recorded and output_state(path) == recorded[path] for path in outputs)
+
+
+def save_manifest(manifest_file, fingerprint, outputs, params):
+    """
+    Сохраняет манифест исследования после успешной сборки.
+
+    :param manifest_file: Путь к манифесту исследования.
+    :param fingerprint: Отпечаток исследования (study_fingerprint).
+    :param outputs: Список путей к выходным файлам.
+    :param params: Параметры конвейера (сохраняются для наглядности).
+    """
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    manifest = {
+        "version": PIPELINE_VERSION,
+        "fingerprint": fingerprint,
+        "params": params,
+        "outputs": {path: output_state(path) for path in outputs},
+    }
+    with atomic_write_path(manifest_file) as tmp_path:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2, default=str)
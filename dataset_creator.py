@@ -1,18 +1,201 @@
 # from collect_png import collect_png_files
-from dicom_to_png_array import png_to_png_directory
-from png_mask_creator import transform
-from rename_files import rename_png_files
-from png_array_to_nii import save_png_to_nifty
+from DICOM_to_png_array import png_to_png_directory, crop_png_arrays, compute_crop_box, compute_study_crop_box, \
+    DEFAULT_SIZE
+from png_mask_creator import transform, create_binary_mask_volume, mask_to_yolo_lines, write_yolo_labels, hsv_bounds
+from slice_index import build_slice_index, slice_file_name, study_number_from_path
+from png_array_to_nii import save_png_to_nifty, save_array_to_nifty
+from build_cache import study_fingerprint, manifest_path, is_up_to_date, save_manifest
+from dataset_store import store_shard_path, write_study_store
+from slice_cache import start_slice_cache, clear_slice_cache, DEFAULT_CACHE_BYTES
+from resize_engine import resize_crops, IMAGE_INTERPOLATION, MASK_INTERPOLATION
+from slice_transforms import make_transform_record, save_transform_record, transform_record_path
+from sparse_labels import encode_rle, encode_png_directory, save_rle, rle_path
+from profiling import stage, record, file_size
+from prefetch import prefetch, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+from PIL import Image
+import numpy as np
+import cv2
+import logging
 import os
 import shutil
 
+logger = logging.getLogger(__name__)
 
-def create_nifty_data(directory_path, directory_path_png, directory_path_mask):
-    study_number_1 = directory_path_png.split(os.sep)[-1].split('.')[0]
-    study_number_2 = directory_path_mask.split(os.sep)[-1].split('.')[0]
 
-    rename_png_files(directory_path_png, study_number_1)
-    rename_png_files(directory_path_mask, study_number_2)
+def save_debug_slices(directory_path_png, directory_path_mask, file_names, images, segmentations, bin_masks):
+    """
+    Сохраняет промежуточные результаты конвейера в памяти в те же директории, что и дисковый конвейер
+    (.cs, .cr, .b, .a). Используется только для отладки.
+    """
+    dir_images = directory_path_png + ".cs"  # КТ снимки png
+    dir_masks = directory_path_mask + ".cr"  # КТ разметка png
+    dir_bin_masks = directory_path_mask + ".b"  # бинарные маски png
+    dir_output_labels = directory_path_mask + ".a"  # аннотации txt
+
+    for directory in (dir_images, dir_masks, dir_bin_masks):
+        os.makedirs(directory, exist_ok=True)
+
+    labels = {}
+    for file_name, image, segmentation, bin_mask in zip(file_names, images, segmentations, bin_masks):
+        Image.fromarray(image).save(os.path.join(dir_images, file_name), format="PNG")
+        Image.fromarray(segmentation).save(os.path.join(dir_masks, file_name), format="PNG")
+        cv2.imwrite(os.path.join(dir_bin_masks, file_name), bin_mask)
+        labels[file_name.replace('.png', '.txt')] = mask_to_yolo_lines(bin_mask)
+
+    write_yolo_labels(labels, dir_output_labels)
+
+
+def nifti_extension(compresslevel):
+    """
+    Расширение выходных NIfTI-файлов: без сжатия (.nii) при compresslevel=0, иначе .nii.gz.
+    """
+    return ".nii" if compresslevel == 0 else ".nii.gz"
+
+
+def nifti_output_paths(directory_path, directory_path_png, directory_path_mask, compresslevel=None):
+    """
+    Возвращает пути к выходным NIfTI-файлам исследования (снимки, разметка).
+    """
+    study_number_1 = study_number_from_path(directory_path_png)
+    study_number_2 = study_number_from_path(directory_path_mask)
+
+    image_nifti_out = os.path.join(directory_path, "images", study_number_1 + "_image" + nifti_extension(compresslevel))
+    mask_nifti_out = os.path.join(directory_path, "labels", study_number_2 + "_label" + nifti_extension(compresslevel))
+    return image_nifti_out, mask_nifti_out
+
+
+def read_png(path):
+    """
+    Декодирует PNG-файл в массив numpy и учитывает прочитанный объем в этапе 'decode'.
+    """
+    record('decode', bytes_read=file_size(path), slices=1)
+    return np.array(Image.open(path))
+
+
+def create_nifty_data_in_memory(directory_path, directory_path_png, directory_path_mask, debug=False,
+                                crop_mode='slice', dtype=np.uint8, compresslevel=None, output_format='nifti',
+                                hsv_profile=None, size=DEFAULT_SIZE, workers=DEFAULT_WORKERS,
+                                queue_depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Однопроходный вариант create_nifty_data: срезы передаются между этапами обрезки, бинаризации
+    и сборки NIfTI в виде массивов numpy, без промежуточных PNG-директорий. Следующие срезы декодируются
+    в пуле потоков (prefetch), пока текущий обрезается.
+
+    :param directory_path: Корневая директория набора данных.
+    :param directory_path_png: Директория с обычными изображениями-файлами.
+    :param directory_path_mask: Директория с размеченными PNG-изображениями.
+    :param debug: Сохранять промежуточные PNG и аннотации (.cs, .cr, .b, .a).
+    :param crop_mode: 'slice' - обрезка каждого среза по его контурам, 'study' - один общий прямоугольник
+        обрезки для всех срезов исследования (compute_crop_box).
+    :param dtype: Тип данных в NIfTI-файлах (np.uint8 или np.int16).
+    :param compresslevel: Уровень сжатия gzip (0 - несжатый .nii, None - по умолчанию nibabel).
+    :param output_format: 'nifti' - пара NIfTI-файлов, 'hdf5' - поблочно сжатый файл исследования
+        в <directory_path>/store (dataset_store).
+    :param hsv_profile: Путь к профилю калибровки границ HSV (hsv_calibration) или None - LOWER_HSV/UPPER_HSV.
+    :param size: Размер стороны срезов после обрезки (512 или 384).
+    :param workers: Количество потоков чтения (0 - без предвыборки).
+    :param queue_depth: Количество срезов, декодируемых впрок.
+    """
+    study_number_1 = study_number_from_path(directory_path_png)
+
+    # Порядок срезов берется из индекса, исходные файлы не переименовываются
+    image_files = build_slice_index(directory_path_png)
+    mask_files = build_slice_index(directory_path_mask)
+
+    if len(image_files) != len(mask_files):
+        raise ValueError("Количество изображений и масок не совпадает!")
+
+    # Для общего прямоугольника обрезки исходные срезы декодируются один раз и используются повторно
+    source_images, crop_box = None, None
+    if crop_mode == 'study':
+        with stage('decode'):
+            source_images = []
+            for _, source_image, error in prefetch([os.path.join(directory_path_png, f) for f in image_files],
+                                                   read_png, workers, queue_depth):
+                if error is not None:
+                    raise error
+                source_images.append(source_image)
+        crop_box = compute_crop_box(source_images)
+
+    def load_pair(pair):
+        image_file, mask_file = pair
+        source_image = read_png(os.path.join(directory_path_png, image_file)) if source_images is None else None
+        return source_image, read_png(os.path.join(directory_path_mask, mask_file))
+
+    loaded_pairs = prefetch(list(zip(image_files, mask_files)), load_pair, workers, queue_depth)
+    images, segmentations, crop_boxes = [], [], []
+    for i in range(len(image_files)):
+        with stage('decode'):
+            _, loaded, error = next(loaded_pairs)
+            if error is not None:
+                raise error
+            source_image, source_segmentation = loaded
+            if source_image is None:
+                source_image = source_images[i]
+
+        with stage('crop'):
+            # Размер срезов изменяется после цикла пакетами одинаковых по размеру срезов (resize_engine)
+            image, segmentation, slice_box = crop_png_arrays(source_image, source_segmentation, resize=False,
+                                                             crop_box=crop_box, return_box=True)
+            crop_boxes.append(slice_box)
+
+            # Те же преобразования, что и при чтении промежуточных PNG: оттенки серого как в PIL, разметка в RGB
+            images.append(np.array(Image.fromarray(image).convert('L')))
+            if segmentation.ndim == 2:
+                segmentation = np.repeat(segmentation[..., None], 3, axis=-1)
+            segmentations.append(segmentation[..., :3])
+        record('crop', slices=1)
+
+    with stage('resize'):
+        images = resize_crops(images, size, IMAGE_INTERPOLATION)
+        segmentations = resize_crops(segmentations, size, MASK_INTERPOLATION)
+    record('resize', slices=len(images))
+
+    # Прямоугольники обрезки и масштаб каждого среза для обратного преобразования (slice_transforms)
+    transform_record = make_transform_record(crop_boxes, source_image.shape, size)
+
+    # Бинаризация всех размеченных срезов исследования
+    with stage('hsv_mask'):
+        bin_masks = create_binary_mask_volume(np.stack(segmentations), *hsv_bounds(hsv_profile), rgb=True)
+    record('hsv_mask', slices=len(segmentations))
+
+    if debug:
+        file_names = [slice_file_name(study_number_1, i) for i in range(len(images))]
+        save_debug_slices(directory_path_png, directory_path_mask, file_names, images, segmentations, bin_masks)
+
+    if output_format == 'hdf5':
+        with stage('store_write'):
+            write_study_store(store_shard_path(directory_path, study_number_1), study_number_1,
+                              np.stack(images).astype(dtype), bin_masks.astype(dtype), crop_box=crop_box,
+                              compresslevel=4 if compresslevel is None else compresslevel,
+                              transform_record=transform_record)
+        record('store_write', slices=len(images),
+               bytes_written=file_size(store_shard_path(directory_path, study_number_1)))
+    else:
+        image_nifti_out, mask_nifti_out = nifti_output_paths(directory_path, directory_path_png, directory_path_mask,
+                                                             compresslevel)
+
+        save_array_to_nifty(np.moveaxis(bin_masks, 0, -1), mask_nifti_out, dtype=dtype, compresslevel=compresslevel)
+        save_array_to_nifty(np.stack(images, axis=-1), image_nifti_out, dtype=dtype, compresslevel=compresslevel)
+        save_transform_record(transform_record, transform_record_path(mask_nifti_out))
+        # Разреженная разметка рядом с NIfTI: срезы с опухолью и количество вокселей без чтения объема
+        save_rle(encode_rle(bin_masks), rle_path(mask_nifti_out))
+
+    logger.debug("create_nifty_data: преобразование исследования %s завершено (%d срезов)", study_number_1,
+                 len(images))
+
+
+def create_nifty_data_on_disk(directory_path, directory_path_png, directory_path_mask, crop_mode='slice',
+                              dtype=np.uint8, compresslevel=None, slice_cache_bytes=DEFAULT_CACHE_BYTES,
+                              hsv_profile=None, size=DEFAULT_SIZE):
+    """
+    Вариант create_nifty_data с промежуточными PNG-директориями (.cs, .cr, .b, .a), которые удаляются в конце.
+    Параметры совпадают с create_nifty_data_in_memory.
+
+    :param slice_cache_bytes: Объем LRU-кэша исходных срезов, общего для прохода снимков и прохода разметки
+        (0 - без кэша).
+    """
+    study_number_1 = study_number_from_path(directory_path_png)
 
     input_directory = directory_path_png  # Директория с обычными изображениями-файлами
     input_directory_segmentation = directory_path_mask  # Директория с размеченными PNG-изображениями
@@ -20,26 +203,120 @@ def create_nifty_data(directory_path, directory_path_png, directory_path_mask):
     dir_masks = directory_path_mask + ".cr"  # КТ разметка png
     dir_images = directory_path_png + ".cs"  # КТ снимки png
 
-    png_to_png_directory(input_directory, '', dir_images)
-    png_to_png_directory(input_directory, input_directory_segmentation, dir_masks)
+    # Исходные срезы декодируются и подготавливаются один раз для обоих проходов
+    if slice_cache_bytes:
+        start_slice_cache(slice_cache_bytes)
+    try:
+        # Общий прямоугольник обрезки вычисляется один раз и применяется и к снимкам, и к разметке
+        crop_box = compute_study_crop_box(input_directory) if crop_mode == 'study' else None
+
+        crop_boxes = png_to_png_directory(input_directory, '', dir_images, crop_box=crop_box, size=size)
+        png_to_png_directory(input_directory, input_directory_segmentation, dir_masks, crop_box=crop_box, size=size)
+    finally:
+        clear_slice_cache()
 
     dir_bin_masks = directory_path_mask + ".b"  # бинарные маски png
     dir_output_labels = directory_path_mask + ".a"  # аннотации txt
 
-    transform(dir_masks, dir_images, dir_bin_masks, dir_output_labels)
+    transform(dir_masks, dir_images, dir_bin_masks, dir_output_labels, hsv_profile=hsv_profile)
 
-    image_nifti_out = directory_path + "\images\\" + study_number_1 + "_image.nii.gz"
-    mask_nifti_out = directory_path + "\labels\\" + study_number_2 + "_label.nii.gz"
+    image_nifti_out, mask_nifti_out = nifti_output_paths(directory_path, directory_path_png, directory_path_mask,
+                                                         compresslevel)
 
-    save_png_to_nifty(dir_bin_masks, mask_nifti_out)
-    save_png_to_nifty(dir_images, image_nifti_out)
+    save_png_to_nifty(dir_bin_masks, mask_nifti_out, dtype=dtype, compresslevel=compresslevel)
+    save_png_to_nifty(dir_images, image_nifti_out, dtype=dtype, compresslevel=compresslevel)
+
+    # Срезы с ошибкой чтения отсутствуют в объеме, поэтому их прямоугольники не записываются
+    source_width, source_height = Image.open(os.path.join(input_directory, build_slice_index(input_directory)[0])).size
+    save_transform_record(make_transform_record([box for box in crop_boxes if box is not None],
+                                                (source_height, source_width), size),
+                          transform_record_path(mask_nifti_out))
+    save_rle(encode_png_directory(dir_bin_masks), rle_path(mask_nifti_out))
 
     shutil.rmtree(dir_bin_masks)
     shutil.rmtree(dir_output_labels)
     shutil.rmtree(dir_masks)
     shutil.rmtree(dir_images)
 
-    print("-" * 100, "\n", f"create_nifty_data: преобразование исследования {study_number_1} завершено!")
+    logger.debug("create_nifty_data: преобразование исследования %s завершено", study_number_1)
+
+
+def create_nifty_data(directory_path, directory_path_png, directory_path_mask, in_memory=False, debug=False,
+                      crop_mode='slice', dtype=np.uint8, compresslevel=None, use_cache=True, hash_contents=False,
+                      output_format='nifti', hsv_profile=None, size=DEFAULT_SIZE):
+    """
+    Преобразует исследование (PNG-снимки и размеченные PNG) в пару NIfTI-файлов images/<номер>_image.nii.gz
+    и labels/<номер>_label.nii.gz. Если выходные файлы уже собраны из тех же входных данных с теми же
+    параметрами (манифест в <directory_path>/.cache), исследование пропускается.
+
+    :param directory_path: Корневая директория набора данных.
+    :param directory_path_png: Директория с обычными изображениями-файлами.
+    :param directory_path_mask: Директория с размеченными PNG-изображениями.
+    :param in_memory: Конвейер в памяти без промежуточных PNG-директорий (create_nifty_data_in_memory).
+    :param debug: Сохранять промежуточные PNG и аннотации (только для in_memory).
+    :param crop_mode: 'slice' - обрезка каждого среза отдельно, 'study' - общий прямоугольник обрезки.
+    :param dtype: Тип данных в NIfTI-файлах (np.uint8 или np.int16).
+    :param compresslevel: Уровень сжатия gzip (0 - несжатый .nii, None - по умолчанию nibabel).
+    :param use_cache: Пропускать исследования с актуальными выходными файлами.
+    :param hash_contents: Сравнивать входные файлы по содержимому, а не по размеру и времени изменения.
+    :param output_format: 'nifti' - пара NIfTI-файлов, 'hdf5' - файл исследования в поблочно сжатом
+        хранилище <directory_path>/store (только для in_memory, см. dataset_store).
+    :param hsv_profile: Путь к профилю калибровки границ HSV (hsv_calibration) или None - LOWER_HSV/UPPER_HSV.
+    :param size: Размер стороны срезов после обрезки (512 или 384).
+    :return: True, если исследование было пересобрано, False - если пропущено.
+    """
+    study_number = study_number_from_path(directory_path_png)
+    if output_format == 'hdf5':
+        if not in_memory:
+            raise ValueError("Формат 'hdf5' поддерживается только конвейером в памяти (in_memory=True)")
+        outputs = [store_shard_path(directory_path, study_number)]
+    elif output_format == 'nifti':
+        outputs = list(nifti_output_paths(directory_path, directory_path_png, directory_path_mask, compresslevel))
+        outputs.extend([transform_record_path(outputs[1]), rle_path(outputs[1])])
+    else:
+        raise ValueError(f"Неизвестный формат выходных данных: {output_format}")
+    input_dirs = [directory_path_png, directory_path_mask]
+
+    # Параметры конвейера, от которых зависят выходные файлы
+    lower_hsv, upper_hsv = hsv_bounds(hsv_profile)
+    params = {
+        "crop_mode": crop_mode,
+        "dtype": np.dtype(dtype).name,
+        "compresslevel": compresslevel,
+        "lower_hsv": np.asarray(lower_hsv).tolist(),
+        "upper_hsv": np.asarray(upper_hsv).tolist(),
+        "resize": size,
+        "resize_interpolation": [IMAGE_INTERPOLATION, MASK_INTERPOLATION],
+        "output_format": output_format,
+        "in_memory": in_memory,
+        "debug": debug,
+    }
+    manifest_file = manifest_path(directory_path, study_number)
+
+    # Входные директории не изменяются конвейером, поэтому отпечаток считается один раз
+    with stage('cache_check'):
+        fingerprint = study_fingerprint(input_dirs, params, hash_contents) if use_cache else None
+        up_to_date = use_cache and is_up_to_date(manifest_file, fingerprint, outputs)
+
+    if up_to_date:
+        logger.info("create_nifty_data: исследование %s не изменилось, пропускаем", study_number)
+        return False
+
+    for output in outputs:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    if in_memory:
+        create_nifty_data_in_memory(directory_path, directory_path_png, directory_path_mask, debug=debug,
+                                    crop_mode=crop_mode, dtype=dtype, compresslevel=compresslevel,
+                                    output_format=output_format, hsv_profile=hsv_profile, size=size)
+    else:
+        create_nifty_data_on_disk(directory_path, directory_path_png, directory_path_mask, crop_mode=crop_mode,
+                                  dtype=dtype, compresslevel=compresslevel, hsv_profile=hsv_profile, size=size)
+
+    if use_cache:
+        save_manifest(manifest_file, fingerprint, outputs, params)
+
+    return True
 
 
 if __name__ == "__main__":
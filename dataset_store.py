@@ -0,0 +1,149 @@
+from atomic_io import atomic_write_path
+import numpy as np
+import logging
+import os
+
+try:
+    import h5py
+except ImportError:  # h5py нужен только для формата хранения 'hdf5'
+    h5py = None
+
+logger = logging.getLogger(__name__)
+
+STORE_NAME = "dataset.h5"
+SHARDS_DIR_NAME = "store"
+
+
+def _require_h5py():
+    if h5py is None:
+        raise ImportError("Для формата хранения 'hdf5' нужен пакет h5py (pip install h5py)")
+
+
+def store_shard_path(directory_path, study_number):
+    """
+    Путь к файлу исследования в хранилище: <directory_path>/store/<номер исследования>.h5.
+    Отдельный файл на исследование позволяет записывать исследования из параллельных процессов.
+    """
+    return os.path.join(directory_path, SHARDS_DIR_NAME, f"{study_number}.h5")
+
+
+def write_study_store(shard_path, study_number, images, labels, pixel_spacing=(1, 1), slice_thickness=1,
+                      crop_box=None, compresslevel=4, transform_record=None):
+    """
+    Записывает исследование в HDF5-файл: снимки и разметка хранятся поблочно (один срез - один сжатый блок),
+    поэтому чтение отдельного среза не требует распаковки всего объема.
+
+    :param shard_path: Путь к файлу исследования (store_shard_path).
+    :param study_number: Номер исследования.
+    :param images: Массив снимков формы (количество срезов, H, W).
+    :param labels: Массив бинарных масок формы (количество срезов, H, W) со значениями 0/255, как в NIfTI-разметке.
+    :param pixel_spacing: Размер пикселя в мм (между строками, между столбцами).
+    :param slice_thickness: Расстояние между срезами в мм.
+    :param crop_box: Общий прямоугольник обрезки (x, y, w, h) - левый верхний угол, ширина и высота
+        (cv2.boundingRect, compute_crop_box) - или None, если срезы обрезались по отдельности.
+    :param compresslevel: Уровень сжатия gzip для блоков (0 - без сжатия).
+    :param transform_record: Запись преобразований срезов (slice_transforms.make_transform_record) или None;
+        сохраняется в подгруппе transform.
+    """
+    _require_h5py()
+    if images.shape != labels.shape:
+        raise ValueError("Размеры снимков и разметки не совпадают!")
+
+    os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+    compression = dict(compression="gzip", compression_opts=compresslevel, shuffle=True) if compresslevel else {}
+    chunks = (1,) + images.shape[1:]
+
+    # Запись во временный файл и атомарная замена: недописанный файл не попадет в хранилище
+    with atomic_write_path(shard_path) as tmp_path, h5py.File(tmp_path, "w") as f:
+        group = f.create_group(str(study_number))
+        group.create_dataset("image", data=images, chunks=chunks, **compression)
+        group.create_dataset("label", data=labels, chunks=chunks, **compression)
+        group.create_dataset("tumour_slices", data=np.flatnonzero(labels.reshape(len(labels), -1).any(axis=1)))
+        group.attrs["study"] = str(study_number)
+        group.attrs["pixel_spacing"] = np.asarray(pixel_spacing, dtype=np.float64)
+        group.attrs["slice_thickness"] = float(slice_thickness)
+        # Прямоугольник обрезки (x, y, w, h); пустой массив - обрезка по каждому срезу отдельно
+        group.attrs["crop_box"] = np.asarray(crop_box if crop_box is not None else [], dtype=np.int64)
+        if transform_record is not None:
+            transform_group = group.create_group("transform")
+            for key, value in transform_record.items():
+                if value.dtype.kind == 'U':
+                    transform_group.attrs[key] = str(value)
+                else:
+                    transform_group.create_dataset(key, data=value)
+
+
+def consolidate_store(directory_path, study_numbers=None, store_path=None):
+    """
+    Собирает файлы исследований в одно хранилище <directory_path>/dataset.h5 через внешние ссылки HDF5:
+    данные не копируются, а файл исследования открывается только при обращении к нему.
+
+    :param directory_path: Корневая директория набора данных.
+    :param study_numbers: Номера исследований (по умолчанию - все файлы в <directory_path>/store).
+    :param store_path: Путь к хранилищу (по умолчанию <directory_path>/dataset.h5).
+    :return: Путь к хранилищу.
+    """
+    _require_h5py()
+    if store_path is None:
+        store_path = os.path.join(directory_path, STORE_NAME)
+    if study_numbers is None:
+        shards_dir = os.path.join(directory_path, SHARDS_DIR_NAME)
+        if os.path.isdir(shards_dir):
+            study_numbers = sorted(f[:-3] for f in os.listdir(shards_dir)
+                                   if f.endswith(".h5") and not f.startswith("."))
+        else:
+            logger.warning("consolidate_store: нет директории файлов исследований %s", shards_dir)
+            study_numbers = []
+
+    linked = 0
+    with atomic_write_path(store_path) as tmp_path, h5py.File(tmp_path, "w") as f:
+        for study_number in study_numbers:
+            shard_path = store_shard_path(directory_path, study_number)
+            if not os.path.exists(shard_path):
+                logger.warning("consolidate_store: нет файла исследования %s", shard_path)
+                continue
+            # Относительный путь: хранилище можно переносить вместе с директорией store
+            f[str(study_number)] = h5py.ExternalLink(os.path.relpath(shard_path, os.path.dirname(store_path)),
+                                                     str(study_number))
+            linked += 1
+
+    logger.info("consolidate_store: %d исследований в %s", linked, store_path)
+    return store_path
+
+
+def open_store(store_path):
+    """
+    Открывает хранилище только для чтения. Данные исследований не читаются до обращения к срезам.
+    """
+    _require_h5py()
+    return h5py.File(store_path, "r")
+
+
+def read_slice(store, study_number, index, kind="image"):
+    """
+    Читает один срез исследования.
+
+    :param store: Открытое хранилище (open_store).
+    :param study_number: Номер исследования.
+    :param index: Номер среза (с 0).
+    :param kind: 'image' - снимок, 'label' - бинарная маска.
+    :return: numpy array формы (H, W).
+    """
+    return store[str(study_number)][kind][index]
+
+
+def study_metadata(store, study_number):
+    """
+    Метаданные исследования: номер, размер пикселя, расстояние между срезами, прямоугольник обрезки
+    (x, y, w, h) или None, форма объема и номера срезов с опухолью.
+    """
+    group = store[str(study_number)]
+    crop_box = group.attrs["crop_box"]
+    return {
+        "study": group.attrs["study"],
+        "pixel_spacing": tuple(float(v) for v in group.attrs["pixel_spacing"]),
+        "slice_thickness": float(group.attrs["slice_thickness"]),
+        "crop_box": tuple(int(v) for v in crop_box) if len(crop_box) else None,
+        "shape": group["image"].shape,
+        "tumour_slices": group["tumour_slices"][()].tolist(),
+    }
@@ -0,0 +1,117 @@
+from png_array_to_nii import save_array_to_nifty
+from windowing import apply_windows, stack_windows
+from slice_index import sort_dicom_headers
+from prefetch import prefetch, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+import pydicom
+import numpy as np
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def read_dicom_series(dicom_dir, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Собирает объем из директории с .dcm файлами одной серии без промежуточных PNG.
+    Сначала читаются только заголовки (для сортировки), затем пиксели каждого среза
+    записываются сразу в заранее выделенный массив. Файлы читаются в пуле потоков (prefetch).
+
+    :param dicom_dir: Директория с DICOM-файлами серии.
+    :param workers: Количество потоков чтения (0 - без предвыборки).
+    :param queue_depth: Количество файлов, читаемых впрок.
+    :return: Кортеж (объем в HU формы (H, W, N) int16, размер пикселя в мм, расстояние между срезами в мм).
+    """
+    dicom_files = [f for f in os.listdir(dicom_dir) if f.endswith('.dcm')]
+    if not dicom_files:
+        raise FileNotFoundError(f"В директории {dicom_dir} нет DICOM-файлов.")
+
+    def read_header(dicom_file):
+        return pydicom.dcmread(os.path.join(dicom_dir, dicom_file), stop_before_pixels=True)
+
+    def read_pixels(dicom_file):
+        return pydicom.dcmread(os.path.join(dicom_dir, dicom_file)).pixel_array
+
+    headers = []
+    for dicom_file, header, error in prefetch(dicom_files, read_header, workers, queue_depth):
+        if error is not None:
+            raise error
+        headers.append((dicom_file, header))
+    headers, positions = sort_dicom_headers(headers)
+
+    first = headers[0][1]
+    rows, columns = int(first.Rows), int(first.Columns)
+    num_slices = len(headers)
+
+    raw_volume = None
+    slopes = np.ones(num_slices, dtype=np.float32)
+    intercepts = np.zeros(num_slices, dtype=np.float32)
+
+    loaded = prefetch([dicom_file for dicom_file, _ in headers], read_pixels, workers, queue_depth)
+    for i, ((dicom_file, header), (_, pixel_array, error)) in enumerate(zip(headers, loaded)):
+        if error is not None:
+            raise error
+
+        if pixel_array.shape != (rows, columns):
+            raise ValueError(f"Размер среза {dicom_file} {pixel_array.shape} не совпадает с ({rows}, {columns})!")
+
+        if raw_volume is None:
+            raw_volume = np.empty((rows, columns, num_slices), dtype=pixel_array.dtype)
+        raw_volume[:, :, i] = pixel_array
+
+        if 'RescaleSlope' in header and 'RescaleIntercept' in header:
+            slopes[i] = float(header.RescaleSlope)
+            intercepts[i] = float(header.RescaleIntercept)
+
+    # Применение рескейлинга (по DICOM-файлу) сразу ко всему объему
+    if np.all(slopes == 1) and np.all(intercepts == np.round(intercepts)):
+        volume = raw_volume.astype(np.int32)
+        volume += intercepts.astype(np.int32)
+    else:
+        volume = raw_volume.astype(np.float32)
+        volume *= slopes
+        volume += intercepts
+        np.rint(volume, out=volume)
+
+    info = np.iinfo(np.int16)
+    volume = np.clip(volume, info.min, info.max).astype(np.int16)
+
+    pixel_spacing = [float(v) for v in first.PixelSpacing] if 'PixelSpacing' in first else [1.0, 1.0]
+
+    # Расстояние между срезами берем по их положению, толщина среза - запасной вариант
+    if positions is not None and num_slices > 1:
+        slice_thickness = float(np.median(np.diff(positions)))
+    else:
+        slice_thickness = float(first.SliceThickness) if 'SliceThickness' in first else 1.0
+
+    if slice_thickness <= 0:
+        slice_thickness = 1.0
+
+    return volume, pixel_spacing, slice_thickness
+
+
+def dicom_series_to_nifty(dicom_dir, nii_out, window=None):
+    """
+    Преобразует директорию с DICOM-серией в NIfTI-файл с реальным размером вокселя.
+
+    :param dicom_dir: Директория с DICOM-файлами серии.
+    :param nii_out: Путь для сохранения NIfTI-файла.
+    :param window: None - сохранить значения HU в int16; имя окна из WINDOW_PRESETS или кортеж (центр, ширина) -
+        сохранить окно в uint8; список окон - сохранить 4D-объем (H, W, N, окно) в uint8.
+    """
+    volume, pixel_spacing, slice_thickness = read_dicom_series(dicom_dir)
+
+    if window is None:
+        save_array_to_nifty(volume, nii_out, pixel_spacing, slice_thickness, dtype=np.int16)
+    elif isinstance(window, list):
+        save_array_to_nifty(stack_windows(volume, window), nii_out, pixel_spacing, slice_thickness, dtype=np.uint8)
+    else:
+        windowed = apply_windows(volume, {'window': window})['window']
+        save_array_to_nifty(windowed, nii_out, pixel_spacing, slice_thickness, dtype=np.uint8)
+
+    logger.info("dicom_series_to_nifty: серия %s сохранена как %s", dicom_dir, nii_out)
+
+
+if __name__ == "__main__":
+    dicom_directory = r"C:\Users\stden\PycharmProjects\Diploma\venv\DICOM\11"
+    nii_output = r"C:\Users\stden\PycharmProjects\Diploma\venv\nii_data\11_image.nii.gz"
+    dicom_series_to_nifty(dicom_directory, nii_output)
@@ -0,0 +1,194 @@
+from slice_index import build_slice_index
+from PIL import Image
+import numpy as np
+import logging
+import json
+import cv2
+import os
+
+logger = logging.getLogger(__name__)
+
+# Диапазоны каналов HSV в OpenCV
+HSV_RANGES = (180, 256, 256)
+
+
+def rgb_to_hsv_pixels(image):
+    """
+    Переводит изображение PIL-формата (H, W) или (H, W, 3/4) в массив пикселей HSV формы (H * W, 3).
+    """
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, axis=-1)
+    hsv = cv2.cvtColor(np.ascontiguousarray(image[..., :3]), cv2.COLOR_RGB2HSV)
+    return hsv.reshape(-1, 3)
+
+
+def overlay_mask(annotated, original=None, min_difference=30, min_saturation=60):
+    """
+    Находит пиксели цветной разметки на срезе.
+    Если есть исходный срез без разметки, разметкой считаются пиксели, отличающиеся от него хотя бы
+    по одному каналу больше чем на min_difference; иначе - насыщенные пиксели (КТ-снимок серый).
+
+    :param annotated: Размеченный срез (H, W, 3/4), RGB.
+    :param original: Исходный срез того же размера или None.
+    :param min_difference: Порог отличия от исходного среза.
+    :param min_saturation: Порог насыщенности, если исходного среза нет.
+    :return: Булева маска формы (H * W,).
+    """
+    annotated = np.asarray(annotated)
+    if original is not None:
+        original = np.asarray(original)
+        if original.ndim == 2:
+            original = np.repeat(original[..., None], 3, axis=-1)
+        difference = np.abs(annotated[..., :3].astype(np.int16) - original[..., :3].astype(np.int16))
+        return (difference.max(axis=-1) > min_difference).reshape(-1)
+
+    return rgb_to_hsv_pixels(annotated)[:, 1] >= min_saturation
+
+
+def sample_study_pixels(directory_path_png, directory_path_mask, pixels_per_slice=2000, seed=0):
+    """
+    Собирает выборку пикселей разметки и фона исследования в HSV.
+
+    :param directory_path_png: Директория с исходными PNG-срезами (или '' - без исходных срезов).
+    :param directory_path_mask: Директория с размеченными PNG-срезами.
+    :param pixels_per_slice: Максимальное количество пикселей разметки (и столько же фона) со среза.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Массивы HSV-пикселей разметки и фона формы (N, 3).
+    """
+    rng = np.random.default_rng(seed)
+    mask_files = build_slice_index(directory_path_mask)
+    image_files = build_slice_index(directory_path_png) if directory_path_png else [None] * len(mask_files)
+
+    overlay_samples, background_samples = [], []
+    for image_file, mask_file in zip(image_files, mask_files):
+        annotated = np.array(Image.open(os.path.join(directory_path_mask, mask_file)))
+        original = None
+        if image_file is not None:
+            original = np.array(Image.open(os.path.join(directory_path_png, image_file)))
+            if original.shape[:2] != annotated.shape[:2]:
+                logger.warning("sample_study_pixels: размеры %s и %s не совпадают, срез пропущен", image_file,
+                               mask_file)
+                continue
+
+        selected = overlay_mask(annotated, original)
+        hsv = rgb_to_hsv_pixels(annotated)
+        for pixels, samples in ((hsv[selected], overlay_samples), (hsv[~selected], background_samples)):
+            if len(pixels) > pixels_per_slice:
+                pixels = pixels[rng.choice(len(pixels), pixels_per_slice, replace=False)]
+            samples.append(pixels)
+
+    empty = np.empty((0, 3), dtype=np.uint8)
+    return (np.concatenate(overlay_samples) if overlay_samples else empty,
+            np.concatenate(background_samples) if background_samples else empty)
+
+
+def hsv_histograms(pixels):
+    """
+    Гистограммы каналов H, S, V выборки пикселей.
+    """
+    return [np.bincount(pixels[:, channel], minlength=size) for channel, size in enumerate(HSV_RANGES)]
+
+
+def propose_hsv_bounds(overlay_pixels, coverage=0.99, margin=5):
+    """
+    Предлагает границы HSV по гистограммам пикселей разметки: для каждого канала берется интервал,
+    содержащий долю coverage пикселей (отсекаются хвосты поровну), и расширяется на margin.
+
+    :param overlay_pixels: HSV-пиксели разметки формы (N, 3).
+    :param coverage: Доля пикселей разметки внутри границ по каждому каналу.
+    :param margin: Запас к границам.
+    :return: Кортеж (нижняя граница, верхняя граница) - numpy array из трех значений H, S, V.
+    """
+    if len(overlay_pixels) == 0:
+        raise ValueError("Нет пикселей разметки для калибровки границ HSV.")
+
+    tail = (1.0 - coverage) / 2
+    lower, upper = [], []
+    for histogram, size in zip(hsv_histograms(overlay_pixels), HSV_RANGES):
+        cumulative = np.cumsum(histogram) / histogram.sum()
+        low = int(np.searchsorted(cumulative, tail))
+        high = int(np.searchsorted(cumulative, 1.0 - tail))
+        lower.append(max(low - margin, 0))
+        upper.append(min(high + margin, size - 1))
+    return np.array(lower), np.array(upper)
+
+
+def bounds_quality(lower, upper, overlay_pixels, background_pixels):
+    """
+    Доля пикселей разметки внутри границ (recall) и доля фоновых пикселей, ошибочно попавших в границы.
+    """
+    def inside(pixels):
+        if len(pixels) == 0:
+            return 0.0
+        return float(np.all((pixels >= lower) & (pixels <= upper), axis=1).mean())
+
+    return {"overlay_recall": inside(overlay_pixels), "background_false_positive": inside(background_pixels)}
+
+
+def calibrate_hsv(directory_path, names, coverage=0.99, margin=5, pixels_per_slice=2000, seed=0):
+    """
+    Пакетная калибровка границ HSV по набору исследований без графического интерфейса
+    (замена interractive_mask_choosing). Исследование <номер> состоит из директорий <номер>.1 (разметка)
+    и <номер>.2 (исходные срезы).
+
+    :param directory_path: Корневая директория набора данных.
+    :param names: Список номеров исследований.
+    :param coverage: Доля пикселей разметки внутри границ по каждому каналу.
+    :param margin: Запас к границам.
+    :param pixels_per_slice: Максимальное количество пикселей со среза.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Профиль: словарь с границами, оценкой качества и гистограммами каналов разметки.
+    """
+    overlay, background = [], []
+    for name in names:
+        directory_path_mask = os.path.join(directory_path, f"{name}.1")
+        directory_path_png = os.path.join(directory_path, f"{name}.2")
+        if not os.path.isdir(directory_path_png):
+            directory_path_png = ''
+
+        study_overlay, study_background = sample_study_pixels(directory_path_png, directory_path_mask,
+                                                              pixels_per_slice, seed)
+        overlay.append(study_overlay)
+        background.append(study_background)
+        logger.info("calibrate_hsv: исследование %s, пикселей разметки %d", name, len(study_overlay))
+
+    overlay, background = np.concatenate(overlay), np.concatenate(background)
+    lower, upper = propose_hsv_bounds(overlay, coverage, margin)
+
+    profile = {
+        "lower_hsv": lower.tolist(),
+        "upper_hsv": upper.tolist(),
+        "studies": [str(name) for name in names],
+        "overlay_pixels": int(len(overlay)),
+        "quality": bounds_quality(lower, upper, overlay, background),
+        "histograms": {channel: histogram.tolist() for channel, histogram in zip("hsv", hsv_histograms(overlay))},
+    }
+    logger.info("calibrate_hsv: границы %s - %s, %s", profile["lower_hsv"], profile["upper_hsv"], profile["quality"])
+    return profile
+
+
+def save_hsv_profile(profile, profile_path):
+    """
+    Сохраняет профиль калибровки HSV в JSON.
+    """
+    with open(profile_path, "w", encoding="utf-8") as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+
+
+def load_hsv_profile(profile_path):
+    """
+    Загружает границы HSV из профиля калибровки.
+
+    :param profile_path: Путь к JSON-профилю (save_hsv_profile).
+    :return: Кортеж (нижняя граница, верхняя граница) - numpy array из трех значений H, S, V.
+    """
+    with open(profile_path, "r", encoding="utf-8") as f:
+        profile = json.load(f)
+    return np.array(profile["lower_hsv"]), np.array(profile["upper_hsv"])
+
+
+if __name__ == "__main__":
+    directory_path = r"C:\Users\stden\PycharmProjects\Diploma\venv\3d_data_ceries"
+    names = [11, 12, 13]
+    save_hsv_profile(calibrate_hsv(directory_path, names), os.path.join(directory_path, "hsv_profile.json"))
@@ -0,0 +1,270 @@
+from dicom_to_nii import read_dicom_series
+from windowing import apply_windows
+from DICOM_to_png_array import compute_crop_box, slice_crop_box, DEFAULT_SIZE
+from resize_engine import resize_stack, resize_crops, IMAGE_INTERPOLATION
+from png_array_to_nii import save_array_to_nifty
+from pipeline_logging import setup_logging
+from slice_transforms import make_transform_record, restore_volume
+from lesion_stats import remove_small_components
+import numpy as np
+import argparse
+import logging
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def load_model(model_path, threads=None):
+    """
+    Загружает модель сегментации для вывода на CPU: .onnx - через onnxruntime, иначе - TorchScript (torch.jit).
+    Обе библиотеки необязательны и импортируются только при загрузке модели своего формата.
+
+    :param model_path: Путь к файлу модели.
+    :param threads: Количество потоков вычислений (None - по умолчанию библиотеки).
+    :return: Функция predict(batch) -> numpy array выходов модели; batch - float32 (B, 1, H, W) или (B, 1, D, H, W).
+    """
+    if model_path.endswith(".onnx"):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        input_name = session.get_inputs()[0].name
+
+        def predict(batch):
+            return session.run(None, {input_name: batch})[0]
+        return predict
+
+    import torch
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    model = torch.jit.load(model_path, map_location="cpu")
+    model.eval()
+
+    def predict(batch):
+        with torch.inference_mode():
+            return model(torch.from_numpy(batch)).numpy()
+    return predict
+
+
+def foreground_probability(outputs):
+    """
+    Вероятность класса "опухоль" по выходам модели формы (B, C, ...): для одного канала - сигмоида,
+    для нескольких - softmax и канал 1.
+    """
+    outputs = outputs.astype(np.float32)
+    if outputs.shape[1] == 1:
+        return 1.0 / (1.0 + np.exp(-outputs[:, 0]))
+    outputs = np.exp(outputs - outputs.max(axis=1, keepdims=True))
+    return outputs[:, 1] / outputs.sum(axis=1)
+
+
+def preprocess_study(volume, window='soft_tissue', size=DEFAULT_SIZE, crop_mode='slice'):
+    """
+    Готовит объем в HU к модели так же, как конвейер набора данных: окно (DICOM_to_png_array), закрашивание
+    служебных полей, обрезка и изменение размера срезов (png_to_png). crop_mode должен совпадать с режимом,
+    в котором собирался набор данных для обучения модели (create_nifty_data).
+
+    :param volume: Объем в HU формы (H, W, N).
+    :param window: Окно из WINDOW_PRESETS или (центр, ширина).
+    :param size: Размер стороны срезов после обрезки.
+    :param crop_mode: 'slice' - обрезка каждого среза по его контурам (как по умолчанию в create_nifty_data),
+        'study' - один общий прямоугольник обрезки для всех срезов.
+    :return: Срезы float32 в [0, 1] формы (N, size, size) и прямоугольники обрезки срезов (x, y, w, h).
+    """
+    windowed = np.moveaxis(apply_windows(volume, {'window': window})['window'], -1, 0)
+    windowed = np.ascontiguousarray(windowed)
+    windowed[:, :19, :] = 0
+    windowed[:, :, :19] = 0
+
+    if crop_mode == 'study':
+        # Общий прямоугольник обрезки: размер всех срезов изменяется пакетно (resize_engine)
+        x, y, w, h = crop_box = compute_crop_box(windowed)
+        slices = resize_stack(windowed[:, y:y + h, x:x + w], size, IMAGE_INTERPOLATION)
+        crop_boxes = [crop_box] * len(windowed)
+    elif crop_mode == 'slice':
+        # Срез без пикселей, отличных от черного и белого, не обрезается
+        height, width = windowed.shape[1:]
+        has_content = ((windowed >= 1) & (windowed <= 254)).any(axis=(1, 2))
+        crop_boxes = [slice_crop_box(image) if content else (0, 0, width, height)
+                      for image, content in zip(windowed, has_content)]
+        slices = resize_crops([image[y:y + h, x:x + w] for image, (x, y, w, h) in zip(windowed, crop_boxes)],
+                              size, IMAGE_INTERPOLATION)
+    else:
+        raise ValueError(f"Неизвестный режим обрезки: {crop_mode}")
+    return slices.astype(np.float32) / 255.0, crop_boxes
+
+
+def predict_slices(predict, slices, batch_size=8):
+    """
+    Вероятности опухоли по срезам, пакетами по batch_size срезов.
+
+    :param predict: Функция модели (load_model).
+    :param slices: Срезы формы (N, H, W).
+    :return: Вероятности формы (N, H, W).
+    """
+    probabilities = np.empty(slices.shape, dtype=np.float32)
+    for start in range(0, len(slices), batch_size):
+        batch = slices[start:start + batch_size, None]
+        probabilities[start:start + batch_size] = foreground_probability(predict(np.ascontiguousarray(batch)))
+    return probabilities
+
+
+def tile_origins(length, tile, step):
+    """
+    Начала окон вдоль оси: с шагом step, последнее окно прижато к концу оси.
+    """
+    if length <= tile:
+        return [0]
+    origins = list(range(0, length - tile, step))
+    return origins + [length - tile]
+
+
+def predict_tiles(predict, volume, tile=(32, 128, 128), overlap=0.5, batch_size=4):
+    """
+    Вероятности опухоли по 3D-окнам со скользящим перекрытием; в перекрытиях вероятности усредняются.
+
+    :param predict: Функция модели (load_model), принимающая (B, 1, D, H, W).
+    :param volume: Объем формы (N, H, W).
+    :param tile: Размер окна (D, H, W).
+    :param overlap: Доля перекрытия соседних окон.
+    :param batch_size: Количество окон в пакете.
+    :return: Вероятности формы (N, H, W).
+    """
+    tile = tuple(min(t, s) for t, s in zip(tile, volume.shape))
+    steps = [max(int(t * (1 - overlap)), 1) for t in tile]
+    origins = [(z, y, x)
+               for z in tile_origins(volume.shape[0], tile[0], steps[0])
+               for y in tile_origins(volume.shape[1], tile[1], steps[1])
+               for x in tile_origins(volume.shape[2], tile[2], steps[2])]
+
+    sums = np.zeros(volume.shape, dtype=np.float32)
+    counts = np.zeros(volume.shape, dtype=np.float32)
+    for start in range(0, len(origins), batch_size):
+        batch_origins = origins[start:start + batch_size]
+        regions = [tuple(slice(o, o + t) for o, t in zip(origin, tile)) for origin in batch_origins]
+        batch = np.stack([volume[region] for region in regions])[:, None]
+        for region, probability in zip(regions, foreground_probability(predict(np.ascontiguousarray(batch)))):
+            sums[region] += probability
+            counts[region] += 1
+    return sums / np.maximum(counts, 1)
+
+
+def restore_geometry(probabilities, crop_boxes, shape, threshold=0.5):
+    """
+    Возвращает маску в исходную (необрезанную) геометрию: вероятности масштабируются обратно
+    к размеру прямоугольника обрезки (slice_transforms.restore_volume), бинаризуются
+    и помещаются в срез исходного размера.
+
+    :param probabilities: Вероятности формы (N, size, size).
+    :param crop_boxes: Прямоугольники обрезки срезов (x, y, w, h) (preprocess_study).
+    :param shape: Размер исходного среза (H, W).
+    :param threshold: Порог бинаризации.
+    :return: Маска uint8 (0/1) формы (H, W, N).
+    """
+    record = make_transform_record(crop_boxes, shape, probabilities.shape[-1])
+    restored = restore_volume(probabilities, record, interpolation="linear")
+    return np.moveaxis(restored >= threshold, 0, -1).astype(np.uint8)
+
+
+def run_inference(dicom_dir, model_path, nii_out, mode='2d', batch_size=8, threads=None, window='soft_tissue',
+                  size=DEFAULT_SIZE, tile=(32, 128, 128), overlap=0.5, threshold=0.5, predict=None,
+                  min_lesion_mm3=0.0, crop_mode='slice'):
+    """
+    Сегментирует DICOM-исследование на CPU и сохраняет маску в NIfTI в исходной геометрии.
+
+    :param dicom_dir: Директория с DICOM-файлами серии.
+    :param model_path: Путь к модели (.onnx или TorchScript).
+    :param nii_out: Путь для сохранения маски.
+    :param mode: '2d' - пакеты срезов, '3d' - скользящие 3D-окна.
+    :param batch_size: Количество срезов (или окон) в пакете.
+    :param threads: Количество потоков вычислений.
+    :param window: Окно из WINDOW_PRESETS или (центр, ширина).
+    :param size: Размер стороны срезов на входе модели.
+    :param tile: Размер 3D-окна (D, H, W).
+    :param overlap: Доля перекрытия 3D-окон.
+    :param threshold: Порог бинаризации вероятностей.
+    :param predict: Уже загруженная модель (load_model), чтобы не загружать ее для каждого исследования.
+    :param min_lesion_mm3: Удалять из маски 3D-компоненты меньшего объема в мм³ (0 - без фильтра).
+    :param crop_mode: Режим обрезки срезов, как при сборке обучающего набора данных ('slice' или 'study').
+    :return: Отчет: время этапов в секундах, количество срезов и срезов в секунду.
+    """
+    timings = {}
+    total_start = time.perf_counter()
+
+    def timed(name, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    if predict is None:
+        predict = timed('load_model', load_model, model_path, threads)
+    volume, pixel_spacing, slice_thickness = timed('read', read_dicom_series, dicom_dir)
+    slices, crop_boxes = timed('preprocess', preprocess_study, volume, window, size, crop_mode)
+
+    if mode == '3d':
+        probabilities = timed('inference', predict_tiles, predict, slices, tile, overlap, batch_size)
+    else:
+        probabilities = timed('inference', predict_slices, predict, slices, batch_size)
+
+    mask = timed('postprocess', restore_geometry, probabilities, crop_boxes, volume.shape[:2], threshold)
+    if min_lesion_mm3 > 0:
+        spacing = (pixel_spacing[0], pixel_spacing[1], slice_thickness)
+        mask, removed = timed('lesion_filter', remove_small_components, mask, min_lesion_mm3, spacing)
+        logger.debug("run_inference: удалено малых компонент: %d", removed)
+    timed('write', save_array_to_nifty, mask, nii_out, pixel_spacing, slice_thickness)
+
+    total = time.perf_counter() - total_start
+    report = {
+        "study": os.path.basename(os.path.normpath(dicom_dir)),
+        "slices": int(volume.shape[2]),
+        "crop_mode": crop_mode,
+        "timings": timings,
+        "latency": total,
+        "slices_per_sec": volume.shape[2] / timings['inference'] if timings['inference'] else None,
+        "end_to_end_slices_per_sec": volume.shape[2] / total,
+    }
+    logger.info("run_inference: %s, %d срезов за %.2f с (модель: %.1f срезов/с)", report["study"], report["slices"],
+                total, report["slices_per_sec"] or 0.0)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сегментация DICOM-исследований на CPU")
+    parser.add_argument("model", help="Путь к модели (.onnx или TorchScript)")
+    parser.add_argument("dicom_dirs", nargs="+", help="Директории с DICOM-сериями")
+    parser.add_argument("--output-dir", default=".", help="Директория для масок <исследование>_pred.nii.gz")
+    parser.add_argument("--mode", choices=["2d", "3d"], default="2d", help="Пакеты срезов или 3D-окна")
+    parser.add_argument("--batch-size", type=int, default=8, help="Количество срезов (окон) в пакете")
+    parser.add_argument("--threads", type=int, default=None, help="Количество потоков вычислений")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE, help="Размер стороны срезов на входе модели")
+    parser.add_argument("--tile", type=int, nargs=3, default=(32, 128, 128), help="Размер 3D-окна (D H W)")
+    parser.add_argument("--overlap", type=float, default=0.5, help="Доля перекрытия 3D-окон")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Порог бинаризации")
+    parser.add_argument("--crop-mode", choices=["slice", "study"], default="slice",
+                        help="Режим обрезки срезов, как при сборке обучающего набора данных")
+    parser.add_argument("--min-lesion", type=float, default=0.0,
+                        help="Минимальный объем 3D-компоненты маски в мм³ (0 - без фильтра)")
+    parser.add_argument("--report", default=None, help="Путь к JSON-отчету о задержках")
+    args = parser.parse_args()
+
+    setup_logging()
+    model = load_model(args.model, args.threads)
+    reports = []
+    for dicom_dir in args.dicom_dirs:
+        study = os.path.basename(os.path.normpath(dicom_dir))
+        reports.append(run_inference(dicom_dir, args.model, os.path.join(args.output_dir, f"{study}_pred.nii.gz"),
+                                     mode=args.mode, batch_size=args.batch_size, threads=args.threads,
+                                     size=args.size, tile=tuple(args.tile), overlap=args.overlap,
+                                     threshold=args.threshold, predict=model,
+                                     min_lesion_mm3=args.min_lesion, crop_mode=args.crop_mode))
+
+    if args.report is not None:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
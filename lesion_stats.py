@@ -0,0 +1,194 @@
+from training_loader import find_study_pairs
+from png_array_to_nii import save_array_to_nifty
+from pipeline_logging import setup_logging
+import nibabel as nib
+import numpy as np
+import argparse
+import logging
+import csv
+import os
+
+try:
+    from scipy import ndimage
+except ImportError:  # scipy нужен только для анализа связных компонент
+    ndimage = None
+
+logger = logging.getLogger(__name__)
+
+# Связность 3D-компонент: количество соседей -> ранг структурного элемента generate_binary_structure
+CONNECTIVITY_RANK = {6: 1, 18: 2, 26: 3}
+
+LESION_FIELDS = ["study", "lesion", "voxels", "volume_mm3", "centroid_x", "centroid_y", "centroid_z",
+                 "bbox_min", "bbox_max", "first_slice", "last_slice", "slice_span", "small"]
+
+
+def _require_scipy():
+    if ndimage is None:
+        raise ImportError("Для анализа связных компонент нужен пакет scipy (pip install scipy)")
+
+
+def label_components(mask, connectivity=26):
+    """
+    Разметка 3D-связных компонент бинарного объема.
+
+    :param mask: Бинарный объем формы (H, W, количество срезов).
+    :param connectivity: Связность: 6, 18 или 26 соседей.
+    :return: Объем номеров компонент (0 - фон) и количество компонент.
+    """
+    _require_scipy()
+    if connectivity not in CONNECTIVITY_RANK:
+        raise ValueError(f"Неизвестная связность: {connectivity} (допустимо 6, 18, 26)")
+    structure = ndimage.generate_binary_structure(3, CONNECTIVITY_RANK[connectivity])
+    return ndimage.label(np.asarray(mask) != 0, structure=structure)
+
+
+def lesion_statistics(labels, count, spacing=(1, 1, 1)):
+    """
+    Статистика компонент за один векторный проход по ненулевым вокселям (np.bincount) и find_objects:
+    объем, центр масс, ограничивающий прямоугольник и диапазон срезов каждого очага.
+
+    :param labels: Объем номеров компонент (label_components) формы (H, W, количество срезов).
+    :param count: Количество компонент.
+    :param spacing: Размер вокселя в мм по осям объема (между строками, между столбцами, между срезами).
+    :return: Словарь массивов numpy длины count: voxels, volume_mm3, centroid (count, 3; в вокселях),
+        bbox_min и bbox_max (count, 3; включительно), first_slice, last_slice, slice_span.
+    """
+    _require_scipy()
+    coordinates = np.nonzero(labels)
+    component = labels[coordinates]
+
+    voxels = np.bincount(component, minlength=count + 1)[1:]
+    centroid = np.stack([np.bincount(component, weights=axis, minlength=count + 1)[1:]
+                         for axis in coordinates], axis=1) / np.maximum(voxels, 1)[:, None]
+
+    boxes = ndimage.find_objects(labels, max_label=count)
+    bbox_min = np.array([[s.start for s in box] for box in boxes], dtype=np.int64).reshape(-1, 3)
+    bbox_max = np.array([[s.stop - 1 for s in box] for box in boxes], dtype=np.int64).reshape(-1, 3)
+
+    return {
+        "voxels": voxels,
+        "volume_mm3": voxels * float(np.prod(spacing)),
+        "centroid": centroid,
+        "bbox_min": bbox_min,
+        "bbox_max": bbox_max,
+        "first_slice": bbox_min[:, 2],
+        "last_slice": bbox_max[:, 2],
+        "slice_span": bbox_max[:, 2] - bbox_min[:, 2] + 1,
+    }
+
+
+def remove_small_components(mask, min_volume_mm3, spacing=(1, 1, 1), connectivity=26):
+    """
+    Удаляет компоненты объемом меньше min_volume_mm3 (фильтр постобработки).
+    Сохраняемые компоненты выбираются таблицей по номеру компоненты, без циклов по срезам.
+
+    :param mask: Бинарный объем формы (H, W, количество срезов).
+    :param min_volume_mm3: Минимальный объем очага в мм³.
+    :param spacing: Размер вокселя в мм по осям объема.
+    :param connectivity: Связность: 6, 18 или 26 соседей.
+    :return: Отфильтрованная маска того же типа и количество удаленных компонент.
+    """
+    labels, count = label_components(mask, connectivity)
+    volume_mm3 = np.bincount(labels.ravel(), minlength=count + 1) * float(np.prod(spacing))
+    keep = volume_mm3 >= min_volume_mm3
+    keep[0] = False
+    filtered = np.where(keep[labels], mask, 0).astype(np.asarray(mask).dtype)
+    return filtered, int(count - keep[1:].sum())
+
+
+def label_spacing(label_path):
+    """
+    Размер вокселя в мм по осям NIfTI-файла разметки.
+    """
+    return tuple(float(v) for v in nib.load(label_path).header.get_zooms()[:3])
+
+
+def study_lesions(label_path, connectivity=26):
+    """
+    Статистика очагов NIfTI-файла разметки (lesion_statistics) с размером вокселя из заголовка.
+    """
+    spacing = label_spacing(label_path)
+    labels, count = label_components(np.asanyarray(nib.load(label_path).dataobj), connectivity)
+    return lesion_statistics(labels, count, spacing)
+
+
+def lesion_rows(study, stats, min_volume_mm3=0.0):
+    """
+    Строки отчета по очагам исследования (LESION_FIELDS).
+    """
+    rows = []
+    for i in range(len(stats["voxels"])):
+        rows.append({
+            "study": study,
+            "lesion": i + 1,
+            "voxels": int(stats["voxels"][i]),
+            "volume_mm3": round(float(stats["volume_mm3"][i]), 3),
+            "centroid_x": round(float(stats["centroid"][i, 1]), 2),
+            "centroid_y": round(float(stats["centroid"][i, 0]), 2),
+            "centroid_z": round(float(stats["centroid"][i, 2]), 2),
+            "bbox_min": " ".join(str(int(v)) for v in stats["bbox_min"][i]),
+            "bbox_max": " ".join(str(int(v)) for v in stats["bbox_max"][i]),
+            "first_slice": int(stats["first_slice"][i]),
+            "last_slice": int(stats["last_slice"][i]),
+            "slice_span": int(stats["slice_span"][i]),
+            "small": int(stats["volume_mm3"][i] < min_volume_mm3),
+        })
+    return rows
+
+
+def lesion_report(directory_path, report_path=None, min_volume_mm3=0.0, connectivity=26):
+    """
+    Отчет контроля качества набора данных: по строке на каждый очаг каждого исследования
+    (исследования без очагов записываются одной строкой с lesion = 0).
+
+    :param directory_path: Директория набора данных (find_study_pairs).
+    :param report_path: Путь к CSV-отчету (по умолчанию lesion_report.csv в directory_path).
+    :param min_volume_mm3: Очаги меньшего объема отмечаются в столбце small.
+    :param connectivity: Связность: 6, 18 или 26 соседей.
+    :return: Список строк отчета.
+    """
+    if report_path is None:
+        report_path = os.path.join(directory_path, "lesion_report.csv")
+
+    rows = []
+    for study, _, label_path in find_study_pairs(directory_path):
+        stats = study_lesions(label_path, connectivity)
+        study_rows = lesion_rows(study, stats, min_volume_mm3)
+        rows.extend(study_rows or [{"study": study, "lesion": 0, "voxels": 0, "volume_mm3": 0.0}])
+        logger.info("lesion_report: исследование %s, очагов %d (малых %d)", study, len(study_rows),
+                    sum(row["small"] for row in study_rows))
+
+    with open(report_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=LESION_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def filter_label_file(label_path, nii_out, min_volume_mm3, connectivity=26, compresslevel=None):
+    """
+    Сохраняет разметку без очагов объемом меньше min_volume_mm3.
+
+    :return: Количество удаленных компонент.
+    """
+    image = nib.load(label_path)
+    spacing = label_spacing(label_path)
+    mask = np.asanyarray(image.dataobj)
+    filtered, removed = remove_small_components(mask, min_volume_mm3, spacing, connectivity)
+    save_array_to_nifty(filtered, nii_out, spacing[:2], spacing[2], dtype=image.get_data_dtype(),
+                        compresslevel=compresslevel)
+    logger.info("filter_label_file: %s, удалено компонент: %d", label_path, removed)
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отчет по 3D-очагам в разметке набора данных")
+    parser.add_argument("directory_path", help="Директория набора данных (images/, labels/)")
+    parser.add_argument("--output", default=None, help="Путь к CSV-отчету (по умолчанию lesion_report.csv)")
+    parser.add_argument("--min-volume", type=float, default=0.0, help="Минимальный объем очага в мм³")
+    parser.add_argument("--connectivity", type=int, choices=sorted(CONNECTIVITY_RANK), default=26,
+                        help="Связность компонент")
+    args = parser.parse_args()
+
+    setup_logging()
+    lesion_report(args.directory_path, args.output, args.min_volume, args.connectivity)
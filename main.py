@@ -1,4 +1,9 @@
-from dataset_creator import create_nifty_data
+from study_runner import run_studies, discover_studies
+from pipeline_logging import setup_logging
+from DICOM_to_png_array import DEFAULT_SIZE
+import numpy as np
+import argparse
+import logging
 import time
 
 # Список номеров исследований для обработки
@@ -70,13 +75,85 @@ names = [
     103
 ]
 
-directory_path = r"C:\Users\stden\PycharmProjects\Diploma\venv\3d_data_ceries"
-start_time = time.time()
-for i in range(len(names)):
-    directory_path_mask = directory_path + "\\" + str(names[i]) + ".1"
-    directory_path_png = directory_path + "\\" + str(names[i]) + ".2"
+def parse_args(argv=None):
+    """
+    Разбирает аргументы командной строки конвейера.
 
-    create_nifty_data(directory_path, directory_path_png, directory_path_mask)
-consumed_time = time.time() - start_time
-avg_time = consumed_time / len(names)
-print("СРЕДНЕЕ ВРЕМЯ ВЫПОЛНЕНИЯ:", avg_time)
+    :param argv: Список аргументов (по умолчанию - sys.argv).
+    """
+    parser = argparse.ArgumentParser(description="Преобразование исследований (PNG-снимки и разметка) в NIfTI")
+    parser.add_argument("directory_path",
+                        help="Корневая директория набора данных с директориями <номер>.1 и <номер>.2")
+    studies = parser.add_mutually_exclusive_group()
+    studies.add_argument("--studies", nargs="+", help="Номера исследований (по умолчанию - список names)")
+    studies.add_argument("--glob", help="Шаблон номеров исследований, например '1*' или '*'")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Количество параллельных процессов (по умолчанию - по числу ядер)")
+    parser.add_argument("--on-disk", action="store_true",
+                        help="Конвейер с промежуточными PNG-директориями вместо конвейера в памяти")
+    parser.add_argument("--debug", action="store_true", help="Сохранять промежуточные PNG и аннотации")
+    parser.add_argument("--crop-mode", choices=["slice", "study"], default="slice",
+                        help="'slice' - обрезка каждого среза отдельно, 'study' - общая обрезка исследования")
+    parser.add_argument("--size", type=int, default=DEFAULT_SIZE, help="Размер стороны срезов после обрезки (512 или 384)")
+    parser.add_argument("--dtype", choices=["uint8", "int16"], default="uint8", help="Тип данных в NIfTI-файлах")
+    parser.add_argument("--compresslevel", type=int, default=None,
+                        help="Уровень сжатия gzip (0 - несжатый .nii, по умолчанию - как в nibabel)")
+    parser.add_argument("--output-format", choices=["nifti", "hdf5"], default="nifti",
+                        help="'nifti' - пары NIfTI-файлов, 'hdf5' - поблочно сжатое хранилище dataset.h5")
+    parser.add_argument("--hsv-profile", default=None, help="Путь к профилю границ HSV (hsv_calibration.py)")
+    parser.add_argument("--no-cache", action="store_true", help="Пересобирать исследования с актуальными файлами")
+    parser.add_argument("--shard-index", type=int, default=0, help="Номер шарда этого узла (с 0)")
+    parser.add_argument("--shard-count", type=int, default=1, help="Количество шардов (узлов)")
+    parser.add_argument("--queue", action="store_true",
+                        help="Захватывать исследования через очередь с файлами блокировки на общей файловой системе")
+    parser.add_argument("--queue-dir", default=None, help="Директория очереди (по умолчанию <набор данных>/.queue)")
+    parser.add_argument("--stale-after", type=float, default=None,
+                        help="Через сколько секунд снимать блокировку упавшего узла")
+    parser.add_argument("--retry-failed", action="store_true", help="Повторять исследования с маркером ошибки")
+    parser.add_argument("--cprofile-study", default=None, help="Номер исследования для профилирования cProfile")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO",
+                        help="Уровень логирования (DEBUG - сообщения по каждому файлу)")
+    parser.add_argument("--quiet", action="store_true", help="Тихий режим: только предупреждения и ошибки")
+    parser.add_argument("--log-file", default=None, help="Путь к файлу журнала")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """
+    Точка входа: обрабатывает выбранные исследования с параметрами из командной строки.
+    """
+    args = parse_args(argv)
+    log_level = getattr(logging, args.log_level)
+    setup_logging(log_level, args.quiet, args.log_file)
+
+    if args.glob is not None:
+        studies = discover_studies(args.directory_path, args.glob)
+    elif args.studies is not None:
+        studies = args.studies
+    else:
+        studies = [str(name) for name in names]
+
+    if not studies:
+        raise SystemExit(f"В {args.directory_path} нет исследований для обработки")
+
+    start_time = time.time()
+    results = run_studies(args.directory_path, studies, workers=args.workers, cprofile_study=args.cprofile_study,
+                log_level=log_level, quiet=args.quiet, shard_index=args.shard_index, shard_count=args.shard_count,
+                use_queue=args.queue, queue_dir=args.queue_dir, stale_after=args.stale_after,
+                retry_failed=args.retry_failed, log_file=args.log_file, in_memory=not args.on_disk,
+                debug=args.debug, crop_mode=args.crop_mode, dtype=np.dtype(args.dtype).type,
+                compresslevel=args.compresslevel, output_format=args.output_format, hsv_profile=args.hsv_profile,
+                use_cache=not args.no_cache, size=args.size)
+    consumed_time = time.time() - start_time
+
+    # Среднее по исследованиям, обработанным этим запуском: исследования других шардов не попадают в results,
+    # а исследования, уже готовые или занятые другим узлом в очереди (done/failed/busy), не обрабатывались
+    processed = [result for result in results if result["status"] in ("ok", "skipped", "error")]
+    if processed:
+        print("СРЕДНЕЕ ВРЕМЯ ВЫПОЛНЕНИЯ:", consumed_time / len(processed))
+    else:
+        print("НЕТ ОБРАБОТАННЫХ ИССЛЕДОВАНИЙ")
+
+
+if __name__ == "__main__":
+    main()
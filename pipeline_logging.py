@@ -0,0 +1,92 @@
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import logging
+import json
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+logger = logging.getLogger(__name__)
+
+# Ошибки обработки отдельных файлов в текущем процессе (собираются в отчет вместо вывода через print)
+_errors = []
+
+
+def setup_logging(level=logging.INFO, quiet=False, log_file=None, log_queue=None):
+    """
+    Настраивает логирование конвейера. Вызывается в основном процессе и в каждом процессе пула.
+
+    :param level: Уровень логирования (logging.DEBUG - сообщения по каждому файлу, logging.INFO - сводки по исследованиям).
+    :param quiet: Тихий режим: выводятся только предупреждения и ошибки.
+    :param log_file: Путь к файлу журнала (по умолчанию - только консоль).
+    :param log_queue: Очередь записей журнала основного процесса (start_log_listener) - для процессов пула:
+        записи попадают в файл журнала через один обработчик, без одновременной записи из нескольких процессов.
+    """
+    if quiet:
+        level = logging.WARNING
+
+    handlers = [logging.StreamHandler()]
+    if log_queue is None and log_file is not None:
+        handlers.append(logging.FileHandler(log_file, encoding="utf-8"))
+
+    logging.basicConfig(level=level, format=LOG_FORMAT, handlers=handlers, force=True)
+
+    if log_queue is not None:
+        # Обработчик очереди добавляется после basicConfig, чтобы не получить LOG_FORMAT: запись форматируется
+        # по LOG_FORMAT один раз - обработчиком файла в основном процессе
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.setFormatter(logging.Formatter("%(message)s"))
+        logging.getLogger().addHandler(queue_handler)
+
+
+def start_log_listener(log_file):
+    """
+    Запускает в основном процессе поток, который пишет в файл журнала записи процессов пула.
+
+    :param log_file: Путь к файлу журнала.
+    :return: Очередь записей (передается в setup_logging процессов пула) и поток записи (listener.stop() в конце).
+    """
+    log_queue = multiprocessing.Queue()
+    handler = logging.FileHandler(log_file, encoding="utf-8")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    return log_queue, listener
+
+
+def record_error(stage, path, error):
+    """
+    Добавляет ошибку обработки файла в отчет и выводит ее в журнал.
+
+    :param stage: Название этапа (например, 'png_to_png').
+    :param path: Путь к файлу, на котором произошла ошибка.
+    :param error: Исключение или текст ошибки.
+    """
+    if isinstance(error, BaseException):
+        error = f"{type(error).__name__}: {error}"
+    _errors.append({"stage": stage, "path": str(path), "error": str(error)})
+    logger.error("%s: %s: %s", stage, path, error)
+
+
+def collect_errors():
+    """
+    Возвращает накопленные ошибки и очищает список.
+    """
+    errors = list(_errors)
+    _errors.clear()
+    return errors
+
+
+def save_error_report(results, report_path):
+    """
+    Сохраняет структурированный отчет об ошибках по исследованиям в JSON.
+
+    :param results: Список записей о результатах исследований (с полями study, status, error, file_errors).
+    :param report_path: Путь к JSON-файлу.
+    """
+    report = [
+        {"study": result["study"], "status": result["status"], "error": result["error"],
+         "file_errors": result.get("file_errors", [])}
+        for result in results if result["status"] == "error" or result.get("file_errors")
+    ]
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
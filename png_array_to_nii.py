@@ -1,61 +1,109 @@
+from slice_index import build_slice_index
+from profiling import profiled, record, file_size
+from prefetch import prefetch, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+from atomic_io import atomic_write_path
+import logging
 import nibabel as nib
 import numpy as np
 from PIL import Image
+import tempfile
+import gzip
 import os
 
+logger = logging.getLogger(__name__)
+
 
 # png_folder = r"C:\Users\stden\PycharmProjects\Diploma\venv\PNG\5.cs"
 # png_out = r"C:\Users\stden\PycharmProjects\Diploma\venv\nii_data\5.cs.nii.gz"
 # png_folder = r"C:\Users\stden\PycharmProjects\Diploma\venv\PNG\5.b"
 # png_out = r"C:\Users\stden\PycharmProjects\Diploma\venv\nii_data\5 .b.nii.gz"
 
-def save_png_to_nifty(png_folder, png_out):
-    png_files = [f for f in os.listdir(png_folder) if f.endswith('.png')]
-
-    max_x, max_y = 0, 0
-    for png_file in png_files:
-        img = Image.open(os.path.join(png_folder, png_file))
-        x, y = img.size
-        max_x = max(max_x, x)
-        max_y = max(max_y, y)
+def sort_filenames_by_number(filenames):
+    # Определяем ключ сортировки: извлекаем число после '_'
+    def extract_number(filename):
+        # Разделяем строку по '_' и берем последнюю часть (число с расширением)
+        number_part = filename.split('_')[-1]
+        # Убираем расширение файла и преобразуем оставшуюся часть в целое число
+        return int(number_part.split('.')[0])
+
+    # Сортируем список с использованием ключа
+    return sorted(filenames, key=extract_number)
+
+
+@profiled('save_png_to_nifty')
+def save_png_to_nifty(png_folder, png_out, dtype=np.uint8, compresslevel=None, workers=DEFAULT_WORKERS,
+                      queue_depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Собирает PNG-срезы директории в NIfTI-файл за один проход по файлам.
+    Срезы записываются в отображенный в память временный файл рядом с png_out,
+    поэтому потребление памяти не зависит от количества срезов. Следующие срезы декодируются
+    в пуле потоков (prefetch), пока текущий записывается в объем.
+
+    :param png_folder: Директория с PNG-срезами <номер исследования>_<номер среза>.png.
+    :param png_out: Путь для сохранения NIfTI-файла (.nii или .nii.gz).
+    :param dtype: Тип данных в NIfTI-файле (np.uint8 или np.int16).
+    :param compresslevel: Уровень сжатия gzip для .nii.gz (0-9, None - по умолчанию nibabel).
+    :param workers: Количество потоков чтения (0 - без предвыборки).
+    :param queue_depth: Количество срезов, декодируемых впрок.
+    """
+    png_files = build_slice_index(png_folder)
 
     num_slices = len(png_files)
+    if num_slices == 0:
+        raise ValueError(f"В директории {png_folder} нет PNG-файлов!")
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(png_out))) as tmp_dir:
+        nifti_array = None
+
+        def read_slice(png_file):
+            return Image.open(os.path.join(png_folder, png_file)).convert('L')
 
-    nifti_array = np.zeros((max_y, max_x, num_slices), dtype=np.uint8)
+        for i, (png_file, img, error) in enumerate(prefetch(png_files, read_slice, workers, queue_depth)):
+            if error is not None:
+                raise error
 
-    def sort_filenames_by_number(filenames):
-        # Определяем ключ сортировки: извлекаем число после '_'
-        def extract_number(filename):
-            # Разделяем строку по '_' и берем последнюю часть (число с расширением)
-            number_part = filename.split('_')[-1]
-            # Убираем расширение файла и преобразуем оставшуюся часть в целое число
-            return int(number_part.split('.')[0])
+            current_x, current_y = img.size
 
-        # Сортируем список с использованием ключа
-        return sorted(filenames, key=extract_number)
+            if nifti_array is None:
+                max_x, max_y = current_x, current_y
+                nifti_array = np.memmap(os.path.join(tmp_dir, "volume.dat"), dtype=np.uint8, mode='w+',
+                                        shape=(max_y, max_x, num_slices))
 
-    png_files = sort_filenames_by_number(png_files)
+            # Проверка, что все изображения одного размера
+            if current_x != max_x or current_y != max_y:
+                raise ValueError(
+                    f"Размер {png_file} ({current_x}x{current_y}) не совпадает с размером первого среза ({max_x}x{max_y})!")
 
-    for i, png_file in enumerate(png_files):
-        img = Image.open(os.path.join(png_folder, png_file))
-        img = img.convert('L')
+            nifti_array[:, :, i] = np.array(img)
+            record('save_png_to_nifty', bytes_read=file_size(os.path.join(png_folder, png_file)), slices=1)
 
-        current_x, current_y = img.size
+        save_array_to_nifty(nifti_array, png_out, dtype=dtype, compresslevel=compresslevel)
+        del nifti_array
 
-        # Проверка, что все изображения одного размера
-        if current_x != max_x or current_y != max_y:
-            raise ValueError(
-                f"Размер {png_file} ({current_x}x{current_y}) не совпадает с максимальным размером ({max_x}x{max_y})!")
+    logger.debug("%s: %d срезов сохранено в %s", png_folder, num_slices, png_out)
 
-        nifti_array[:, :, i] = np.array(img)
 
-    pixel_spacing = [1, 1]
+@profiled('nifti_write')
+def save_array_to_nifty(nifti_array, nii_out, pixel_spacing=(1, 1), slice_thickness=1, dtype=np.uint8,
+                        compresslevel=None):
+    """
+    Сохраняет объем (H, W, количество срезов) в NIfTI-файл с приведением к LPI.
+
+    :param nifti_array: Массив срезов формы (H, W, N).
+    :param nii_out: Путь для сохранения NIfTI-файла.
+    :param pixel_spacing: Размер пикселя в мм (между строками, между столбцами).
+    :param slice_thickness: Расстояние между срезами в мм.
+    :param dtype: Тип данных в NIfTI-файле.
+    :param compresslevel: Уровень сжатия gzip для .nii.gz (0-9, None - по умолчанию nibabel).
+    """
+    pixel_spacing = [float(pixel_spacing[0]), float(pixel_spacing[1])]
+    slice_thickness = float(slice_thickness)
 
     # Приводим к LPI
     affine = np.array([
         [pixel_spacing[0], 0, 0, 0],
         [0, pixel_spacing[1], 0, 0],
-        [0, 0, 1, 0],
+        [0, 0, slice_thickness, 0],
         [0, 0, 0, 1]
     ])
 
@@ -75,8 +123,16 @@ def save_png_to_nifty(png_folder, png_out):
 
     affine = rotation_1 @ rotation_2 @ affine
 
-    nifti_image = nib.Nifti1Image(nifti_array, affine, dtype=np.int32)
-    nifti_image.header['pixdim'] = [1.0, pixel_spacing[0], pixel_spacing[1], 1.0, 1.0, 1.0, 1.0, 1.0]
-    nib.save(nifti_image, png_out)
+    nifti_image = nib.Nifti1Image(nifti_array, affine, dtype=dtype)
+    nifti_image.header['pixdim'] = [1.0, pixel_spacing[0], pixel_spacing[1], slice_thickness, 1.0, 1.0, 1.0, 1.0]
+
+    # Запись через временный файл: другие процессы не увидят недописанный NIfTI
+    with atomic_write_path(nii_out) as tmp_out:
+        if compresslevel is None or not nii_out.endswith('.gz'):
+            nib.save(nifti_image, tmp_out)
+        else:
+            with gzip.open(tmp_out, 'wb', compresslevel=compresslevel) as f:
+                nifti_image.to_file_map(nib.Nifti1Image.make_file_map({'image': f}))
+
+    record('nifti_write', bytes_written=file_size(nii_out), slices=nifti_array.shape[2])
 
-    print(f'{png_file} saved')
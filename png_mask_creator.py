@@ -1,9 +1,82 @@
 import numpy as np
 import os
 import cv2
+from slice_index import build_slice_index
+from profiling import profiled, stage, record, file_size
+from pipeline_logging import record_error
+from prefetch import prefetch, DEFAULT_WORKERS, DEFAULT_QUEUE_DEPTH
+from hsv_calibration import load_hsv_profile
+import logging
 
+logger = logging.getLogger(__name__)
 
-def create_binary_mask(image_path, path_out, lower_hsv, upper_hsv):
+# Параметры HSV для выделенных опухолей
+LOWER_HSV = np.array([40, 40, 40])  # Минимальные значения H, S, V
+UPPER_HSV = np.array([150, 255, 255])  # Максимальные значения H, S, V
+
+
+def hsv_bounds(hsv_profile=None):
+    """
+    Возвращает границы HSV для бинаризации разметки.
+
+    Параметры:
+    - hsv_profile: str или None, путь к профилю калибровки (hsv_calibration.calibrate_hsv);
+      если не задан, используются LOWER_HSV и UPPER_HSV.
+
+    Возвращает:
+    - (lower_hsv, upper_hsv): нижняя и верхняя границы.
+    """
+    if hsv_profile is None:
+        return LOWER_HSV, UPPER_HSV
+    return load_hsv_profile(hsv_profile)
+
+
+def binary_mask_from_array(image, lower_hsv, upper_hsv, rgb=False):
+    """
+    Создает бинарную маску по массиву пикселей размеченного изображения.
+
+    Параметры:
+    - image: numpy array, изображение (H, W, 3) или (H, W, 4); альфа-канал игнорируется.
+    - lower_hsv: tuple, нижняя граница цвета в формате HSV (H, S, V).
+    - upper_hsv: tuple, верхняя граница цвета в формате HSV (H, S, V).
+    - rgb: bool, порядок каналов RGB (как у PIL) вместо BGR (как у OpenCV).
+
+    Возвращает:
+    - binary_mask: бинарная маска.
+    """
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        rgb = False
+
+    hsv_image = cv2.cvtColor(np.ascontiguousarray(image[..., :3]),
+                             cv2.COLOR_RGB2HSV if rgb else cv2.COLOR_BGR2HSV)
+
+    return cv2.inRange(hsv_image, lower_hsv, upper_hsv)
+
+
+def create_binary_mask_volume(volume, lower_hsv, upper_hsv, rgb=False):
+    """
+    Создает бинарные маски для всех размеченных изображений объема: binary_mask_from_array по каждому срезу
+    с записью в заранее выделенный массив.
+
+    Параметры:
+    - volume: numpy array, изображения формы (..., H, W, 3) или (..., H, W, 4); альфа-канал игнорируется.
+    - lower_hsv: tuple, нижняя граница цвета в формате HSV (H, S, V).
+    - upper_hsv: tuple, верхняя граница цвета в формате HSV (H, S, V).
+    - rgb: bool, порядок каналов RGB (как у PIL) вместо BGR (как у OpenCV).
+
+    Возвращает:
+    - binary_masks: numpy array uint8 формы (..., H, W).
+    """
+    volume = np.asarray(volume)
+    slices = volume.reshape((-1,) + volume.shape[-3:])
+    binary_masks = np.empty(slices.shape[:-1], dtype=np.uint8)
+    for k, image in enumerate(slices):
+        binary_masks[k] = binary_mask_from_array(image, lower_hsv, upper_hsv, rgb=rgb)
+    return binary_masks.reshape(volume.shape[:-1])
+
+
+def create_binary_mask(image_path, path_out, lower_hsv, upper_hsv, image=None):
     """
     Функция для создания бинарной маски на изображении.
 
@@ -12,29 +85,28 @@ def create_binary_mask(image_path, path_out, lower_hsv, upper_hsv):
     - path_out: str, путь для сохранения бинарной маски.
     - lower_hsv: tuple, нижняя граница цвета в формате HSV (H, S, V).
     - upper_hsv: tuple, верхняя граница цвета в формате HSV (H, S, V).
+    - image: numpy array или None, заранее прочитанное изображение (BGR), например из предвыборки.
 
     Возвращает:
     - binary_mask: бинарная маска.
     - contours: список найденных контуров.
     """
     # Шаг 1: Загрузка изображения
-    image = cv2.imread(image_path)
+    if image is None:
+        image = cv2.imread(image_path)
 
     if image is None:
         raise FileNotFoundError(f"Изображение не найдено: {image_path}")
 
-    # Шаг 2: Преобразование в HSV
-    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-
-    # Шаг 3: Создание бинарной маски по заданным границам HSV
-    binary_mask = cv2.inRange(hsv_image, lower_hsv, upper_hsv)
+    # Шаг 2: Преобразование в HSV и создание бинарной маски по заданным границам HSV
+    binary_mask = binary_mask_from_array(image, lower_hsv, upper_hsv)
 
     success = cv2.imwrite(path_out, binary_mask)
 
     if success:
-        print(f"Бинарная маска сохранена как {path_out}")
+        logger.debug("Бинарная маска сохранена как %s", path_out)
     else:
-        print(f"Ошибка при сохранении бинарной маски: {path_out}")
+        record_error('create_binary_mask', path_out, "Ошибка при сохранении бинарной маски")
 
     return binary_mask
 
@@ -47,7 +119,6 @@ def mask_to_polygons(mask):
     :return: Список многоугольников в формате [[x1, y1, x2, y2, ..., xn, yn], ...].
     """
     contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-    print(contours)
     polygons = []
     for contour in contours:
         # Уплощаем контур в одномерный массив [x1, y1, x2, y2, ..., xn, yn]
@@ -68,16 +139,79 @@ def polygon_to_yolo_format(polygon, img_width, img_height, class_id=0):
     :return: Строка аннотации в формате YOLO для сегментации.
     """
     # Нормализация координат многоугольника
-    normalized_polygon = [
-        coord / img_width if i % 2 == 0 else coord / img_height
-        for i, coord in enumerate(polygon)
-    ]
+    normalized_polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2) / np.array([img_width, img_height])
 
     # Формирование строки в формате YOLO
-    yolo_format = f"{class_id} " + " ".join(f"{coord:.6f}" for coord in normalized_polygon)
+    yolo_format = f"{class_id} " + format_coordinates(normalized_polygon.ravel())
     return yolo_format
 
 
+def format_coordinates(values):
+    """
+    Векторно форматирует нормализованные координаты как " ".join(f"{v:.6f}" for v in values):
+    строка собирается из массива ASCII-символов без цикла Python по координатам.
+
+    :param values: Одномерный массив координат в диапазоне [0, 10).
+    :return: Строка координат через пробел.
+    """
+    micro = np.rint(np.asarray(values, dtype=np.float64) * 1e6).astype(np.int64)
+    if micro.size == 0:
+        return ""
+    if micro.min() < 0 or micro.max() >= 10 * 1000000:
+        return " ".join(f"{value:.6f}" for value in values)
+
+    integer, fraction = np.divmod(micro, 1000000)
+
+    # Каждая координата занимает 9 символов: "d.dddddd "
+    chars = np.empty((micro.size, 9), dtype=np.uint8)
+    chars[:, 0] = ord('0') + integer
+    chars[:, 1] = ord('.')
+    for k in range(6):
+        chars[:, 2 + k] = ord('0') + fraction // 10 ** (5 - k) % 10
+    chars[:, 8] = ord(' ')
+
+    return chars.tobytes()[:-1].decode('ascii')
+
+
+def mask_to_yolo_lines(mask, class_id=0, epsilon=0.0):
+    """
+    Преобразует бинарную маску среза в строки аннотации YOLO: все точки контура нормализуются как массив.
+
+    :param mask: Бинарная маска (numpy array, shape=(H, W)).
+    :param class_id: ID класса объекта.
+    :param epsilon: Допуск упрощения многоугольника cv2.approxPolyDP в пикселях (0 - без упрощения).
+    :return: Список строк в формате YOLO для сегментации.
+    """
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    scale = np.array([mask.shape[1], mask.shape[0]], dtype=np.float64)
+
+    lines = []
+    for contour in contours:
+        if epsilon > 0:
+            contour = cv2.approxPolyDP(contour, epsilon, True)
+        if len(contour) < 3:  # Многоугольник должен иметь хотя бы 3 точки
+            continue
+        normalized = contour.reshape(-1, 2) / scale
+        lines.append(f"{class_id} " + format_coordinates(normalized.ravel()))
+    return lines
+
+
+def write_yolo_labels(labels, dir_output_labels):
+    """
+    Записывает аннотации всего исследования за один проход: текст каждого файла собирается заранее
+    и записывается одним вызовом write.
+
+    :param labels: Словарь {имя файла .txt: список строк YOLO}.
+    :param dir_output_labels: Директория для сохранения аннотаций.
+    """
+    os.makedirs(dir_output_labels, exist_ok=True)
+    for label_name, lines in labels.items():
+        label_path = os.path.join(dir_output_labels, label_name)
+        with open(label_path, "w", buffering=1 << 16) as f:
+            f.write("".join(line + "\n" for line in lines))
+        record('yolo_labels', bytes_written=file_size(label_path), slices=1)
+
+
 def interractive_mask_choosing(fn):
     def nothing(args):
         pass
@@ -125,12 +259,14 @@ def interractive_mask_choosing(fn):
     cv2.destroyAllWindows()
 
 
-def transform(dir_masks, dir_images, dir_bin_masks, dir_output_labels):
+@profiled('transform')
+def transform(dir_masks, dir_images, dir_bin_masks, dir_output_labels, epsilon=0.0, workers=DEFAULT_WORKERS,
+              queue_depth=DEFAULT_QUEUE_DEPTH, hsv_profile=None):
+    # Границы подбираются без графического интерфейса: hsv_calibration.calibrate_hsv -> save_hsv_profile
     # interractive_mask_choosing(r"C:\Users\stden\PycharmProjects\Diploma\Nephrogr.ph.  1.5  Br40  4_149.png")
 
-    # Параметры HSV для выделенных опухолей
-    lower_hsv = np.array([40, 40, 40])  # Минимальные значения H, S, V
-    upper_hsv = np.array([150, 255, 255])  # Максимальные значения H, S, V
+    # Параметры HSV для выделенных опухолей (из профиля калибровки, если он задан)
+    lower_hsv, upper_hsv = hsv_bounds(hsv_profile)
 
     # Пути к директориям
     # dir_masks = r"C:\Users\stden\PycharmProjects\DIPLOMA\venv\PNG\69.cr"  # КТ разметка png
@@ -148,43 +284,53 @@ def transform(dir_masks, dir_images, dir_bin_masks, dir_output_labels):
     output_bin_masks = [os.path.join(dir_bin_masks, f) for f in file_names]
 
     # Создание бинарных масок и сохранение их в директорию
-    for k in range(len(input_mask)):
-        create_binary_mask(input_mask[k], output_bin_masks[k], lower_hsv, upper_hsv)
-
-    # Получение списка файлов
-    image_files = sorted([f for f in os.listdir(dir_images) if f.endswith('.png')])
-    bin_mask_files = sorted([f for f in os.listdir(dir_bin_masks) if f.endswith('.png')])
+    # (следующие файлы читаются в пуле потоков, пока обрабатывается текущий)
+    with stage('hsv_mask'):
+        for k, (_, image, error) in enumerate(prefetch(input_mask, cv2.imread, workers, queue_depth)):
+            if error is not None:
+                record_error('create_binary_mask', input_mask[k], error)
+                continue
+            create_binary_mask(input_mask[k], output_bin_masks[k], lower_hsv, upper_hsv, image=image)
+            record('hsv_mask', bytes_read=file_size(input_mask[k]), bytes_written=file_size(output_bin_masks[k]),
+                   slices=1)
+
+    # Получение списка файлов в порядке срезов
+    image_files = build_slice_index(dir_images)
+    bin_mask_files = build_slice_index(dir_bin_masks)
 
     # Убедитесь, что количество файлов совпадает
     assert len(image_files) == len(bin_mask_files), "Количество изображений и масок не совпадает!"
 
-    for i, (image_file, mask_file) in enumerate(zip(image_files, bin_mask_files)):
-        # Создание полных путей к файлам
-        image_path = os.path.join(dir_images, image_file)
-        label_path = os.path.join(dir_bin_masks, mask_file)
+    # Создание полных путей к файлам
+    path_pairs = [(os.path.join(dir_images, image_file), os.path.join(dir_bin_masks, mask_file))
+                  for image_file, mask_file in zip(image_files, bin_mask_files)]
 
+    def read_pair(paths):
         # Чтение изображения и бинарной маски
-        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        mask = cv2.imread(label_path, cv2.IMREAD_GRAYSCALE)
+        return cv2.imread(paths[0], cv2.IMREAD_GRAYSCALE), cv2.imread(paths[1], cv2.IMREAD_GRAYSCALE)
+
+    labels = {}
+    loaded_pairs = prefetch(path_pairs, read_pair, workers, queue_depth)
+    for i, ((image_path, label_path), pair, error) in enumerate(loaded_pairs):
+        if error is not None:
+            record_error('transform', label_path, error)
+            continue
+        image, mask = pair
+        image_file = image_files[i]
 
         # Убедитесь, что размеры совпадают
         assert image.shape == mask.shape, f"Размеры изображения и маски не совпадают для {image_file}"
 
-        # Нахождение bounding boxes
-        bboxes = mask_to_polygons(mask)
-
-        # Имена для выходных файлов
-        output_label_name = bin_mask_files[i].replace('.png', '.txt')
+        record('transform', bytes_read=file_size(image_path) + file_size(label_path), slices=1)
 
-        # Сохранение аннотаций
-        output_label_path = os.path.join(dir_output_labels, output_label_name)
+        # Нахождение контуров и аннотаций YOLO
+        with stage('contours'):
+            labels[bin_mask_files[i].replace('.png', '.txt')] = mask_to_yolo_lines(mask, class_id=0, epsilon=epsilon)
 
-        with open(output_label_path, "w") as f:
-            for bbox in bboxes:
-                yolo_annotation = polygon_to_yolo_format(bbox, img_width=image.shape[1], img_height=image.shape[0],
-                                                         class_id=0)
-                f.write(yolo_annotation + "\n")
-        print(f"Аннотация сохранена как {output_label_path}")
+    # Сохранение аннотаций всего исследования
+    with stage('yolo_labels'):
+        write_yolo_labels(labels, dir_output_labels)
+    logger.debug("Аннотации (%d файлов) сохранены в %s", len(labels), dir_output_labels)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+# Параметры предвыборки по умолчанию (для сетевых хранилищ можно увеличить)
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_DEPTH = 8
+
+
+def prefetch(items, loader, workers=DEFAULT_WORKERS, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Читает файлы в пуле потоков заранее, пока обрабатывается текущий срез.
+    Результаты выдаются в исходном порядке; одновременно загружено не более queue_depth элементов.
+    Ошибка чтения не прерывает обход, а возвращается вместе с элементом.
+
+    :param items: Последовательность элементов (например, путей к файлам).
+    :param loader: Функция чтения одного элемента (например, cv2.imread или pydicom.dcmread).
+    :param workers: Количество потоков чтения (0 - последовательное чтение без пула).
+    :param queue_depth: Максимальное количество элементов, загруженных впрок.
+    :return: Генератор кортежей (элемент, результат loader или None, исключение или None).
+    """
+    if workers <= 0:
+        for item in items:
+            try:
+                yield item, loader(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append((item, executor.submit(loader, item)))
+                if len(pending) >= max(queue_depth, 1):
+                    break
+
+            while pending:
+                item, future = pending.popleft()
+
+                # Освободившееся место в очереди сразу занимается следующим элементом
+                for next_item in items:
+                    pending.append((next_item, executor.submit(loader, next_item)))
+                    break
+
+                try:
+                    yield item, future.result(), None
+                except Exception as e:
+                    yield item, None, e
+        finally:
+            for _, future in pending:
+                future.cancel()
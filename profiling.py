@@ -0,0 +1,146 @@
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import cProfile
+import pstats
+import json
+import time
+import csv
+import os
+
+# Профиль исследования, которое обрабатывается в текущем процессе (None - профилирование выключено)
+_current_profile = None
+
+# Счетчики обновляются и из потоков предвыборки (prefetch), поэтому изменение этапа выполняется под блокировкой
+_lock = threading.Lock()
+
+STAGE_FIELDS = ["wall", "cpu", "calls", "bytes_read", "bytes_written", "slices"]
+
+
+def start_study_profile(study):
+    """
+    Начинает сбор статистики по этапам для исследования в текущем процессе.
+
+    :param study: Номер исследования.
+    :return: Словарь профиля {"study": ..., "stages": {этап: {wall, cpu, calls, bytes_read, bytes_written, slices}}}.
+    """
+    global _current_profile
+    _current_profile = {"study": study, "stages": {}}
+    return _current_profile
+
+
+def finish_study_profile():
+    """
+    Завершает сбор статистики и возвращает профиль исследования (или None, если он не начинался).
+    """
+    global _current_profile
+    profile, _current_profile = _current_profile, None
+    return profile
+
+
+def _stage_entry(name):
+    return _current_profile["stages"].setdefault(name, {field: 0 for field in STAGE_FIELDS})
+
+
+def record(name, bytes_read=0, bytes_written=0, slices=0, **counters):
+    """
+    Добавляет объем прочитанных/записанных данных, количество срезов и произвольные счетчики к этапу.
+    """
+    if _current_profile is None:
+        return
+    with _lock:
+        entry = _stage_entry(name)
+        entry["bytes_read"] += bytes_read
+        entry["bytes_written"] += bytes_written
+        entry["slices"] += slices
+        for key, value in counters.items():
+            entry[key] = entry.get(key, 0) + value
+
+
+@contextmanager
+def stage(name):
+    """
+    Контекстный менеджер, измеряющий реальное и процессорное время этапа.
+    Вложенные этапы учитываются независимо (время включает вложенные вызовы).
+    """
+    if _current_profile is None:
+        yield
+        return
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        with _lock:
+            entry = _stage_entry(name)
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            entry["calls"] += 1
+
+
+def profiled(name):
+    """
+    Декоратор: выполняет функцию внутри stage(name).
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def file_size(path):
+    """
+    Размер файла в байтах (0, если файла нет).
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def save_stage_report(profiles, json_path=None, csv_path=None):
+    """
+    Сохраняет статистику по этапам для набора исследований в JSON и/или CSV (одна строка на этап исследования).
+
+    :param profiles: Список профилей (start_study_profile/finish_study_profile).
+    :param json_path: Путь к JSON-отчету.
+    :param csv_path: Путь к CSV-отчету.
+    """
+    profiles = [profile for profile in profiles if profile]
+
+    if json_path is not None:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(profiles, f, ensure_ascii=False, indent=2)
+
+    if csv_path is not None:
+        rows = [dict(study=profile["study"], stage=name, **values)
+                for profile in profiles for name, values in profile["stages"].items()]
+        fieldnames = ["study", "stage"] + STAGE_FIELDS
+        fieldnames += sorted({key for row in rows for key in row} - set(fieldnames))
+        with open(csv_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, restval=0)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def run_with_cprofile(func, *args, output_path=None, top=30, **kwargs):
+    """
+    Выполняет func(*args, **kwargs) под cProfile (например, для одного исследования),
+    печатает самые затратные функции и при необходимости сохраняет статистику для snakeviz/pstats.
+
+    :param func: Профилируемая функция.
+    :param output_path: Путь к .prof файлу.
+    :param top: Количество выводимых строк.
+    :return: Результат func.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        if output_path is not None:
+            profiler.dump_stats(output_path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
@@ -1,7 +1,12 @@
+from profiling import profiled, record
+import logging
 import os
 import re
 
+logger = logging.getLogger(__name__)
 
+
+@profiled('rename_png_files')
 def rename_png_files(directory, study_number):
     """
     Переименовывает все .png файлы в указанной директории по шаблону <номер исследования>_<номер маски>.png
@@ -11,7 +16,7 @@ def rename_png_files(directory, study_number):
     """
 
     if not os.path.exists(directory):
-        print(f"rename_png_files: Директория {directory} не существует.")
+        logger.warning("rename_png_files: Директория %s не существует.", directory)
         return
 
     files = [f for f in os.listdir(directory) if f.endswith('.png')]
@@ -23,11 +28,11 @@ def rename_png_files(directory, study_number):
         # Полные пути для старого и нового имени файла
         old_path = os.path.join(directory, file_name)
         new_path = os.path.join(directory, new_file_name)
-        print("rename_png_files: ", old_path, new_path)
 
         if (old_path != new_path):
             os.rename(old_path, new_path)
-            print(f"rename_png_files: Переименовано: {file_name} -> {new_file_name}")
+            record('rename_png_files', slices=1)
+            logger.debug("rename_png_files: Переименовано: %s -> %s", file_name, new_file_name)
 
 
 def rename_dcm_files(directory, study_number):
@@ -51,7 +56,7 @@ def rename_dcm_files(directory, study_number):
         return float('inf')  # Если число не найдено, ставим его в конец списка
 
     if not os.path.exists(directory):
-        print(f"Директория {directory} не существует.")
+        logger.warning("rename_dcm_files: Директория %s не существует.", directory)
         return
 
     files = [f for f in os.listdir(directory) if f.endswith('.dcm')]
@@ -65,7 +70,7 @@ def rename_dcm_files(directory, study_number):
         new_path = os.path.join(directory, new_file_name)
 
         os.rename(old_path, new_path)
-        print(f"Переименовано: {file_name} -> {new_file_name}")
+        logger.debug("rename_dcm_files: Переименовано: %s -> %s", file_name, new_file_name)
 
 
 if __name__ == "__main__":
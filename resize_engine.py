@@ -0,0 +1,85 @@
+import numpy as np
+import cv2
+
+# Размер срезов после обрезки по умолчанию (допустим также 384)
+DEFAULT_SIZE = 512
+
+# Интерполяция снимков: 'area' - усреднение по площади (cv2.INTER_AREA) при уменьшении и бикубическая
+# при увеличении; разметки - ближайший сосед, чтобы не смешивать цвета контуров перед порогом HSV
+IMAGE_INTERPOLATION = "area"
+MASK_INTERPOLATION = "nearest"
+
+INTERPOLATION_FLAGS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "cubic": cv2.INTER_CUBIC,
+    "area": cv2.INTER_AREA,
+}
+
+def interpolation_flag(interpolation, source_shape, size):
+    """
+    Флаг интерполяции cv2 для изменения размера source_shape (h, w) -> (size, size).
+    'area' при увеличении хотя бы по одной оси заменяется бикубической интерполяцией.
+    """
+    if interpolation not in INTERPOLATION_FLAGS:
+        raise ValueError(f"Неизвестная интерполяция: {interpolation}")
+    if interpolation == "area" and (size > source_shape[0] or size > source_shape[1]):
+        return cv2.INTER_CUBIC
+    return INTERPOLATION_FLAGS[interpolation]
+
+
+def resize_stack(stack, size=DEFAULT_SIZE, interpolation=IMAGE_INTERPOLATION):
+    """
+    Изменяет размер стопки срезов одного размера: каждый срез обрабатывается отдельным вызовом cv2.resize
+    и записывается сразу в заранее выделенный результат. Срезы не складываются в каналы одного изображения:
+    cv2.INTER_AREA при нецелом коэффициенте уменьшения принимает не более 4 каналов, а перестановка осей
+    для пакета стоит дороже самих вызовов cv2.resize.
+
+    :param stack: Срезы формы (N, h, w) или (N, h, w, C).
+    :param size: Размер стороны среза после изменения размера.
+    :param interpolation: 'area' - для снимков, 'nearest' - для масок и разметки, также 'linear' и 'cubic'.
+    :return: Массив формы (N, size, size) или (N, size, size, C) того же типа.
+    """
+    stack = np.asarray(stack)
+    num_slices, height, width = stack.shape[:3]
+    flag = interpolation_flag(interpolation, (height, width), size)
+
+    result = np.empty((num_slices, size, size) + stack.shape[3:], dtype=stack.dtype)
+    if num_slices == 0:
+        return result
+
+    for k in range(num_slices):
+        result[k] = cv2.resize(np.ascontiguousarray(stack[k]), (size, size),
+                               interpolation=flag).reshape(result.shape[1:])
+    return result
+
+
+def resize_slice(image, size=DEFAULT_SIZE, interpolation=IMAGE_INTERPOLATION):
+    """
+    Изменяет размер одного среза (h, w) или (h, w, C) (resize_stack).
+    """
+    return resize_stack(np.asarray(image)[None], size, interpolation)[0]
+
+
+def resize_crops(crops, size=DEFAULT_SIZE, interpolation=IMAGE_INTERPOLATION):
+    """
+    Изменяет размер срезов разного размера (например, обрезанных каждый по своему прямоугольнику):
+    срезы группируются по размеру, и каждая группа обрабатывается вызовом resize_stack.
+
+    :param crops: Список срезов (h_i, w_i) или (h_i, w_i, C).
+    :return: Массив формы (N, size, size) или (N, size, size, C) в порядке crops.
+    """
+    if not crops:
+        return np.empty((0, size, size), dtype=np.uint8)
+
+    groups = {}
+    for i, crop in enumerate(crops):
+        groups.setdefault(crop.shape, []).append(i)
+
+    result = None
+    for indices in groups.values():
+        resized = resize_stack(np.stack([crops[i] for i in indices]), size, interpolation)
+        if result is None:
+            result = np.empty((len(crops),) + resized.shape[1:], dtype=resized.dtype)
+        result[indices] = resized
+    return result
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+from profiling import record
+import threading
+
+# Кэш декодированных исходных срезов исследования, которое обрабатывается в текущем процессе
+# (None - кэш выключен). Порядок элементов - от давно использованных к недавно использованным.
+_cache = None
+_cache_bytes = 0
+_max_bytes = 0
+_lock = threading.Lock()
+
+DEFAULT_CACHE_BYTES = 1 << 30
+
+
+def start_slice_cache(max_bytes=DEFAULT_CACHE_BYTES):
+    """
+    Включает LRU-кэш исходных срезов для текущего исследования.
+
+    :param max_bytes: Максимальный объем закэшированных массивов в байтах.
+    """
+    global _cache, _cache_bytes, _max_bytes
+    with _lock:
+        _cache, _cache_bytes, _max_bytes = OrderedDict(), 0, max_bytes
+
+
+def clear_slice_cache():
+    """
+    Выключает кэш и освобождает память (вызывается после обработки исследования).
+    """
+    global _cache, _cache_bytes
+    with _lock:
+        _cache, _cache_bytes = None, 0
+
+
+def cached_slice(key, loader):
+    """
+    Возвращает закэшированное значение по ключу или вычисляет его через loader() и кладет в кэш.
+    Попадания и промахи учитываются в этапе 'slice_cache' отчета (счетчики hits/misses).
+
+    :param key: Ключ (например, абсолютный путь к исходному файлу).
+    :param loader: Функция без аргументов, возвращающая список значений
+        (объем кэша считается по сумме nbytes входящих в него массивов numpy).
+    :return: Значение из кэша или результат loader().
+    """
+    global _cache_bytes
+    if _cache is None:
+        return loader()
+
+    with _lock:
+        value = _cache.get(key)
+        if value is not None:
+            _cache.move_to_end(key)
+    if value is not None:
+        record('slice_cache', hits=1)
+        return value
+
+    value = loader()
+    size = sum(getattr(item, 'nbytes', 0) for item in value)
+    record('slice_cache', misses=1)
+
+    with _lock:
+        if _cache is None or size > _max_bytes:
+            return value
+        if key not in _cache:
+            _cache[key] = value
+            _cache_bytes += size
+        # Вытеснение давно использованных срезов при превышении объема
+        while _cache_bytes > _max_bytes:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= sum(getattr(item, 'nbytes', 0) for item in evicted)
+            record('slice_cache', evictions=1)
+    return value
@@ -0,0 +1,77 @@
+from functools import lru_cache
+import numpy as np
+import pydicom
+import os
+import re
+
+
+def natural_sort_key(filename):
+    """
+    Ключ "естественной" сортировки: числа в имени файла сравниваются как числа (2_9.png < 2_10.png).
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', filename)]
+
+
+def sort_dicom_headers(headers):
+    """
+    Сортирует заголовки срезов серии по положению вдоль нормали к плоскости среза (ImagePositionPatient).
+    Если положения нет, сортирует по InstanceNumber.
+
+    :param headers: Список кортежей (имя файла, заголовок pydicom).
+    :return: Отсортированный список и массив положений срезов в мм (или None).
+    """
+    first = headers[0][1]
+    if all('ImagePositionPatient' in ds for _, ds in headers):
+        if 'ImageOrientationPatient' in first:
+            orientation = np.array(first.ImageOrientationPatient, dtype=np.float64)
+            normal = np.cross(orientation[:3], orientation[3:])
+        else:
+            normal = np.array([0.0, 0.0, 1.0])
+
+        positions = np.array([np.dot(normal, np.array(ds.ImagePositionPatient, dtype=np.float64))
+                              for _, ds in headers])
+        order = np.argsort(positions, kind='stable')
+        return [headers[i] for i in order], positions[order]
+
+    order = sorted(range(len(headers)), key=lambda i: int(getattr(headers[i][1], 'InstanceNumber', 0) or 0))
+    return [headers[i] for i in order], None
+
+
+@lru_cache(maxsize=256)
+def _cached_slice_index(directory, extension, directory_mtime_ns):
+    file_names = [f for f in os.listdir(directory) if f.endswith(extension)]
+
+    if extension == '.dcm' and file_names:
+        headers = [(f, pydicom.dcmread(os.path.join(directory, f), stop_before_pixels=True)) for f in file_names]
+        headers, _ = sort_dicom_headers(headers)
+        return tuple(f for f, _ in headers)
+
+    return tuple(sorted(file_names, key=natural_sort_key))
+
+
+def build_slice_index(directory, extension='.png'):
+    """
+    Возвращает имена файлов директории исследования в порядке срезов, не изменяя сами файлы.
+    DICOM-файлы упорядочиваются по ImagePositionPatient/InstanceNumber, остальные - естественной сортировкой имен.
+    Индекс кэшируется и пересчитывается только при изменении содержимого директории.
+
+    :param directory: Директория исследования.
+    :param extension: Расширение файлов срезов ('.png' или '.dcm').
+    :return: Кортеж имен файлов; позиция в кортеже - номер среза (с 0).
+    """
+    directory = os.path.abspath(directory)
+    return _cached_slice_index(directory, extension, os.stat(directory).st_mtime_ns)
+
+
+def study_number_from_path(directory):
+    """
+    Номер исследования по имени его директории: <номер>.1, <номер>.2 и т.д. (разделитель пути любой ОС).
+    """
+    return os.path.basename(os.path.normpath(directory)).split('.')[0]
+
+
+def slice_file_name(study_number, position, extension='.png'):
+    """
+    Имя промежуточного файла среза: <номер исследования>_<номер среза с 1><расширение>.
+    """
+    return f"{study_number}_{position + 1}{extension}"
@@ -0,0 +1,168 @@
+from atomic_io import atomic_write_path
+from resize_engine import IMAGE_INTERPOLATION
+import numpy as np
+
+# Интерполяция при изменении размера снимков в crop_prepared_arrays (resize_engine)
+RESIZE_INTERPOLATION = IMAGE_INTERPOLATION
+
+
+def sidecar_path(nii_out, suffix):
+    """
+    Путь к дополнительному файлу рядом с выходным объемом: <имя без .nii/.nii.gz><suffix>.
+    """
+    for extension in (".nii.gz", ".nii"):
+        if nii_out.endswith(extension):
+            return nii_out[:-len(extension)] + suffix
+    return nii_out + suffix
+
+
+def transform_record_path(nii_out):
+    """
+    Путь к записи преобразований рядом с выходным объемом: <имя без .nii/.nii.gz>_transform.npz.
+    """
+    return sidecar_path(nii_out, "_transform.npz")
+
+
+def make_transform_record(crop_boxes, source_shape, size, interpolation=RESIZE_INTERPOLATION):
+    """
+    Компактная запись преобразований исследования: прямоугольник обрезки каждого среза, размер исходного
+    среза, размер после изменения размера, масштаб по осям и интерполяция.
+
+    :param crop_boxes: Прямоугольники обрезки срезов (x, y, w, h) в порядке срезов.
+    :param source_shape: Размер исходного среза (H, W).
+    :param size: Размер стороны среза после изменения размера.
+    :param interpolation: Интерполяция при изменении размера.
+    :return: Словарь массивов numpy.
+    """
+    crop_boxes = np.asarray(crop_boxes, dtype=np.int32).reshape(-1, 4)
+    return {
+        "crop_boxes": crop_boxes,
+        "source_shape": np.asarray(source_shape[:2], dtype=np.int32),
+        "size": np.int32(size),
+        # Масштаб (размер после / размер до) по осям x и y для каждого среза
+        "scale": np.stack([size / np.maximum(crop_boxes[:, 2], 1), size / np.maximum(crop_boxes[:, 3], 1)],
+                          axis=1).astype(np.float32),
+        "interpolation": np.array(interpolation),
+    }
+
+
+def save_transform_record(record, path):
+    """
+    Сохраняет запись преобразований (make_transform_record) в .npz.
+    """
+    with atomic_write_path(path) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **record)
+
+
+def load_transform_record(path):
+    """
+    Загружает запись преобразований из .npz.
+    """
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def source_coordinates(offsets, lengths, count, size):
+    """
+    Координаты исходных пикселей в системе среза после изменения размера (центры пикселей, как в билинейной
+    и бикубической интерполяции PIL и OpenCV). Для ближайшего соседа см. nearest_indices.
+
+    :param offsets: Начала прямоугольников обрезки по оси для каждого среза, форма (N,).
+    :param lengths: Размеры прямоугольников обрезки по оси, форма (N,).
+    :param count: Размер исходного среза по оси.
+    :param size: Размер среза после изменения размера.
+    :return: Дробные координаты формы (N, count) и маска пикселей внутри прямоугольника обрезки.
+    """
+    pixels = np.arange(count, dtype=np.float32)[None, :]
+    offsets = offsets[:, None].astype(np.float32)
+    lengths = np.maximum(lengths[:, None], 1).astype(np.float32)
+    inside = (pixels >= offsets) & (pixels < offsets + lengths)
+    return (pixels - offsets + 0.5) * (size / lengths) - 0.5, inside
+
+
+def nearest_indices(offsets, lengths, count, size):
+    """
+    Номера пикселей среза после изменения размера, из которых cv2.INTER_NEAREST взял значения исходных пикселей.
+    cv2 берет для пикселя d исходный пиксель min(floor(d * ifx), length - 1), ifx = 1 / (size / length);
+    обратное отображение - первый d, для которого этот номер не меньше s (примерно ceil(s * size / length)).
+    При увеличении каждый исходный пиксель восстанавливается точно.
+
+    :param offsets: Начала прямоугольников обрезки по оси для каждого среза, форма (N,).
+    :param lengths: Размеры прямоугольников обрезки по оси, форма (N,).
+    :param count: Размер исходного среза по оси.
+    :param size: Размер среза после изменения размера.
+    :return: Номера пикселей формы (N, count) и маска пикселей внутри прямоугольника обрезки.
+    """
+    source = np.arange(count, dtype=np.float64)[None, :] - offsets[:, None].astype(np.float64)
+    lengths = np.maximum(lengths[:, None], 1).astype(np.float64)
+    inside = (source >= 0) & (source < lengths)
+    inverse_scale = 1.0 / (size / lengths)
+
+    def forward(d):
+        return np.minimum(np.floor(d * inverse_scale), lengths - 1)
+
+    # Приближение ceil и поправка на округление с плавающей точкой, как в cv2
+    d = np.ceil(source * size / lengths)
+    d = np.where((d > 0) & (forward(d - 1) >= source), d - 1, d)
+    d = np.where(forward(d) < source, d + 1, d)
+    return np.clip(d, 0, size - 1).astype(np.intp), inside
+
+
+def restore_volume(volume, record, interpolation="nearest", slice_axis=0):
+    """
+    Векторное обратное преобразование: переводит срезы size x size (например, маски или вероятности модели)
+    в исходную геометрию всех срезов за один вызов. Пиксели вне прямоугольника обрезки равны нулю.
+
+    :param volume: Объем срезов после обрезки формы (N, size, size) или (size, size, N).
+    :param record: Запись преобразований (make_transform_record/load_transform_record).
+    :param interpolation: 'nearest' - для масок, 'linear' - для вероятностей.
+    :param slice_axis: Ось срезов в volume (0 или -1); результат имеет ту же раскладку.
+    :return: Объем исходного размера (N, H, W) или (H, W, N) того же типа.
+    """
+    volume = np.asarray(volume)
+    if slice_axis != 0:
+        volume = np.moveaxis(volume, slice_axis, 0)
+
+    crop_boxes = record["crop_boxes"]
+    height, width = (int(v) for v in record["source_shape"])
+    size = int(record["size"])
+    if len(crop_boxes) != len(volume):
+        raise ValueError(f"Количество срезов ({len(volume)}) не совпадает с записью преобразований "
+                         f"({len(crop_boxes)})")
+
+    slices = np.arange(len(volume))[:, None, None]
+
+    if interpolation == "nearest":
+        # Соглашение cv2.INTER_NEAREST, которым изменяется размер масок (resize_engine)
+        row_index, rows_inside = nearest_indices(crop_boxes[:, 1], crop_boxes[:, 3], height, size)
+        column_index, columns_inside = nearest_indices(crop_boxes[:, 0], crop_boxes[:, 2], width, size)
+        inside = rows_inside[:, :, None] & columns_inside[:, None, :]
+        restored = volume[slices, row_index[:, :, None], column_index[:, None, :]]
+    elif interpolation == "linear":
+        rows, rows_inside = source_coordinates(crop_boxes[:, 1], crop_boxes[:, 3], height, size)
+        columns, columns_inside = source_coordinates(crop_boxes[:, 0], crop_boxes[:, 2], width, size)
+        inside = rows_inside[:, :, None] & columns_inside[:, None, :]
+        rows = np.clip(rows, 0, size - 1)
+        columns = np.clip(columns, 0, size - 1)
+        row_0 = np.minimum(rows.astype(np.intp), size - 2 if size > 1 else 0)
+        column_0 = np.minimum(columns.astype(np.intp), size - 2 if size > 1 else 0)
+        row_weight = (rows - row_0)[:, :, None]
+        column_weight = (columns - column_0)[:, None, :]
+        row_0, column_0 = row_0[:, :, None], column_0[:, None, :]
+        row_1, column_1 = np.minimum(row_0 + 1, size - 1), np.minimum(column_0 + 1, size - 1)
+
+        data = volume.astype(np.float32)
+        top = data[slices, row_0, column_0] * (1 - column_weight) + data[slices, row_0, column_1] * column_weight
+        bottom = data[slices, row_1, column_0] * (1 - column_weight) + data[slices, row_1, column_1] * column_weight
+        restored = top * (1 - row_weight) + bottom * row_weight
+        if volume.dtype.kind in 'iu':
+            restored = np.rint(restored)
+        restored = restored.astype(volume.dtype)
+    else:
+        raise ValueError(f"Неизвестная интерполяция: {interpolation}")
+
+    restored = np.where(inside, restored, 0).astype(volume.dtype)
+    if slice_axis != 0:
+        restored = np.moveaxis(restored, 0, slice_axis)
+    return restored
@@ -0,0 +1,147 @@
+from atomic_io import atomic_write_path
+from slice_index import build_slice_index
+from slice_transforms import sidecar_path
+from PIL import Image
+import numpy as np
+import os
+
+
+def rle_path(nii_out):
+    """
+    Путь к разреженной разметке рядом с NIfTI-файлом разметки: <имя без .nii/.nii.gz>_rle.npz.
+    """
+    return sidecar_path(nii_out, "_rle.npz")
+
+
+def encode_rle(volume):
+    """
+    Векторное кодирование бинарного объема длинами серий по строкам срезов (построчный обход среза).
+    Для каждого среза хранятся начала и длины серий ненулевых пикселей, смещения серий среза
+    и количество вокселей, поэтому запросы по срезам не требуют распаковки.
+
+    :param volume: Бинарный объем формы (N, H, W) (любой ненулевой пиксель - опухоль).
+    :return: Словарь массивов numpy: shape, starts, lengths, slice_offsets (N + 1), voxel_counts (N).
+    """
+    volume = np.asarray(volume)
+    num_slices = volume.shape[0]
+    flat = volume.reshape(num_slices, -1) != 0
+
+    # Границы серий - ненулевые разности соседних пикселей среза, дополненного нулями с обеих сторон
+    padded = np.zeros((num_slices, flat.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = flat
+    changes = np.diff(padded, axis=1)
+    slice_index, starts = np.nonzero(changes == 1)
+    _, ends = np.nonzero(changes == -1)
+
+    lengths = (ends - starts).astype(np.int32)
+    runs_per_slice = np.bincount(slice_index, minlength=num_slices)
+    return {
+        "shape": np.asarray(volume.shape, dtype=np.int64),
+        "starts": starts.astype(np.int32),
+        "lengths": lengths,
+        "slice_offsets": np.concatenate([[0], np.cumsum(runs_per_slice)]).astype(np.int64),
+        "voxel_counts": np.bincount(slice_index, weights=lengths, minlength=num_slices).astype(np.int64),
+    }
+
+
+def concatenate_rle(parts):
+    """
+    Объединяет разреженную разметку последовательных частей объема (например, закодированных по пакетам срезов).
+    """
+    shape = parts[0]["shape"].copy()
+    shape[0] = sum(int(part["shape"][0]) for part in parts)
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total_runs = 0
+    for part in parts:
+        offsets.append(part["slice_offsets"][1:] + total_runs)
+        total_runs += int(part["slice_offsets"][-1])
+    return {
+        "shape": shape,
+        "starts": np.concatenate([part["starts"] for part in parts]),
+        "lengths": np.concatenate([part["lengths"] for part in parts]),
+        "slice_offsets": np.concatenate(offsets),
+        "voxel_counts": np.concatenate([part["voxel_counts"] for part in parts]),
+    }
+
+
+def encode_png_directory(png_folder, chunk_size=64):
+    """
+    Кодирует PNG-срезы директории (в порядке build_slice_index) пакетами по chunk_size срезов,
+    чтобы не держать весь объем в памяти.
+    """
+    png_files = build_slice_index(png_folder)
+    if not png_files:
+        raise ValueError(f"В директории {png_folder} нет PNG-файлов!")
+
+    parts = []
+    for start in range(0, len(png_files), chunk_size):
+        chunk = np.stack([np.array(Image.open(os.path.join(png_folder, png_file)).convert('L'))
+                          for png_file in png_files[start:start + chunk_size]])
+        parts.append(encode_rle(chunk))
+    return concatenate_rle(parts)
+
+
+def decode_rle(rle, first=0, last=None):
+    """
+    Векторное декодирование срезов [first, last) через накопленную сумму границ серий.
+
+    :param rle: Разреженная разметка (encode_rle).
+    :param first: Первый срез.
+    :param last: Срез после последнего (по умолчанию - все срезы).
+    :return: Объем uint8 (0/1) формы (last - first, H, W).
+    """
+    num_slices, height, width = (int(v) for v in rle["shape"])
+    last = num_slices if last is None else last
+    slice_size = height * width
+
+    run_first, run_last = int(rle["slice_offsets"][first]), int(rle["slice_offsets"][last])
+    starts = rle["starts"][run_first:run_last].astype(np.int64)
+    lengths = rle["lengths"][run_first:run_last]
+
+    # Номер среза каждой серии (относительно first)
+    counts = np.diff(rle["slice_offsets"][first:last + 1])
+    slice_index = np.repeat(np.arange(last - first, dtype=np.int64), counts)
+    starts += slice_index * slice_size
+
+    boundaries = np.zeros((last - first) * slice_size + 1, dtype=np.int8)
+    np.add.at(boundaries, starts, 1)
+    np.add.at(boundaries, starts + lengths, -1)
+    return np.cumsum(boundaries[:-1], dtype=np.int8).astype(np.uint8).reshape(last - first, height, width)
+
+
+def decode_slice(rle, index):
+    """
+    Декодирует один срез формы (H, W).
+    """
+    return decode_rle(rle, index, index + 1)[0]
+
+
+def tumour_slices(rle):
+    """
+    Номера срезов, на которых есть опухоль (без распаковки).
+    """
+    return np.flatnonzero(rle["voxel_counts"])
+
+
+def tumour_volume(rle, voxel_volume=1.0):
+    """
+    Объем опухоли по всем срезам (количество вокселей, умноженное на объем вокселя в мм³).
+    """
+    return float(rle["voxel_counts"].sum()) * voxel_volume
+
+
+def save_rle(rle, path):
+    """
+    Сохраняет разреженную разметку в .npz.
+    """
+    with atomic_write_path(path) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **rle)
+
+
+def load_rle(path):
+    """
+    Загружает разреженную разметку из .npz.
+    """
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
@@ -0,0 +1,231 @@
+from dataset_creator import create_nifty_data
+from profiling import start_study_profile, finish_study_profile, save_stage_report, run_with_cprofile
+from pipeline_logging import setup_logging, start_log_listener, collect_errors, save_error_report
+from dataset_store import consolidate_store
+from slice_index import natural_sort_key
+from work_queue import shard_studies, claim_study, finish_study, QUEUE_DIR_NAME
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
+import logging
+import socket
+import glob
+import csv
+import os
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def process_study(directory_path, study_name, study_options=None, cprofile=False, queue=None):
+    """
+    Обрабатывает одно исследование и возвращает запись о результате.
+    Исключения не пробрасываются наружу: сбой одного исследования не должен останавливать остальные.
+
+    :param directory_path: Корневая директория набора данных.
+    :param study_name: Номер исследования (например, 11).
+    :param study_options: Дополнительные параметры create_nifty_data (например, in_memory, debug).
+    :param cprofile: Выполнить исследование под cProfile (статистика в profile_<номер>.prof).
+    :param queue: Параметры очереди на общей файловой системе (queue_dir, stale_after, retry_failed)
+        или None - без очереди.
+    :return: Словарь с номером исследования, статусом, временем выполнения, текстом ошибки,
+        ошибками отдельных файлов (file_errors) и статистикой по этапам (stages).
+        Если исследование не захвачено в очереди, статус - 'done', 'failed' или 'busy' (claim_study).
+    """
+    if queue is not None:
+        state = claim_study(queue["queue_dir"], study_name, queue["stale_after"], queue["retry_failed"])
+        if state != "claimed":
+            logger.info("исследование %s: пропущено, состояние в очереди: %s", study_name, state)
+            return {"study": study_name, "status": state, "time": 0.0, "error": "", "file_errors": [], "stages": {}}
+
+    directory_path_mask = os.path.join(directory_path, f"{study_name}.1")
+    directory_path_png = os.path.join(directory_path, f"{study_name}.2")
+
+    start_time = time.time()
+    start_study_profile(study_name)
+    collect_errors()
+    try:
+        if cprofile:
+            rebuilt = run_with_cprofile(create_nifty_data, directory_path, directory_path_png, directory_path_mask,
+                                        output_path=os.path.join(directory_path, f"profile_{study_name}.prof"),
+                                        **(study_options or {}))
+        else:
+            rebuilt = create_nifty_data(directory_path, directory_path_png, directory_path_mask,
+                                        **(study_options or {}))
+        status, error = "ok" if rebuilt else "skipped", ""
+    except Exception:
+        status, error = "error", traceback.format_exc()
+    profile = finish_study_profile()
+    file_errors = collect_errors()
+    consumed_time = round(time.time() - start_time, 3)
+
+    # Сводка по исследованию вместо сообщений по каждому файлу
+    logger.info("исследование %s: %s за %s с, ошибок в файлах: %d", study_name, status, consumed_time,
+                len(file_errors))
+
+    result = {
+        "study": study_name,
+        "status": status,
+        "time": consumed_time,
+        "error": error,
+        "file_errors": file_errors,
+        "stages": profile["stages"],
+    }
+
+    # Маркер завершения записывается после атомарной записи всех выходных файлов
+    if queue is not None:
+        finish_study(queue["queue_dir"], study_name, result)
+
+    return result
+
+
+def discover_studies(directory_path, pattern="*"):
+    """
+    Находит исследования набора данных: номера, для которых есть директории <номер>.1 (разметка)
+    и <номер>.2 (снимки).
+
+    :param directory_path: Корневая директория набора данных.
+    :param pattern: Шаблон номера исследования в стиле glob (например, '1*').
+    :return: Список номеров исследований (строки) в естественном порядке.
+    """
+    studies = []
+    for mask_dir in glob.glob(os.path.join(glob.escape(directory_path), f"{pattern}.1")):
+        study_name = os.path.basename(mask_dir)[:-len(".1")]
+        if os.path.isdir(mask_dir) and os.path.isdir(os.path.join(directory_path, f"{study_name}.2")):
+            studies.append(study_name)
+    return sorted(studies, key=natural_sort_key)
+
+
+def study_key(directory_path, study_name):
+    """
+    Полный нормализованный путь исследования (без суффиксов .1/.2): одинаковые исследования,
+    заданные по-разному (11 и '11', 'a/../11'), дают один ключ.
+    """
+    return os.path.normpath(os.path.abspath(os.path.join(directory_path, str(study_name))))
+
+
+def save_summary(results, summary_path):
+    """
+    Сохраняет сводку по исследованиям (номер, статус, время, ошибка) в CSV-файл.
+
+    :param results: Список записей, возвращаемых process_study.
+    :param summary_path: Путь к CSV-файлу.
+    """
+    with open(summary_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["study", "status", "time", "error"], extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def run_studies(directory_path, names, workers=None, summary_path=None, cprofile_study=None, log_level=logging.INFO,
+                quiet=False, shard_index=0, shard_count=1, use_queue=False, queue_dir=None, stale_after=None,
+                retry_failed=False, log_file=None, **study_options):
+    """
+    Параллельно обрабатывает исследования в пуле процессов: одно исследование на один процесс.
+
+    :param directory_path: Корневая директория набора данных.
+    :param names: Список номеров исследований.
+    :param workers: Количество процессов (по умолчанию - количество ядер, 1 - без пула).
+    :param summary_path: Путь к CSV-сводке (по умолчанию study_summary.csv в directory_path);
+        рядом сохраняются отчет по этапам stage_report.json/stage_report.csv и отчет об ошибках error_report.json.
+    :param cprofile_study: Номер исследования, которое нужно выполнить под cProfile.
+    :param log_level: Уровень логирования в процессах пула.
+    :param quiet: Тихий режим логирования в процессах пула (только предупреждения и ошибки).
+    :param shard_index: Номер шарда этого узла (с 0); обрабатываются только исследования шарда (shard_studies).
+    :param shard_count: Количество шардов (узлов).
+    :param use_queue: Захватывать исследования через очередь на общей файловой системе (work_queue):
+        несколько узлов могут обрабатывать один и тот же список исследований.
+    :param queue_dir: Директория очереди (по умолчанию <directory_path>/.queue).
+    :param stale_after: Через сколько секунд блокировка упавшего узла снимается (больше времени
+        обработки самого долгого исследования; None - не снимается).
+    :param retry_failed: Повторно обрабатывать исследования с маркером ошибки.
+    :param log_file: Файл журнала основного процесса: записи процессов пула передаются в него через очередь.
+    :param study_options: Дополнительные параметры create_nifty_data (например, in_memory, debug).
+    :return: Список записей о результатах в порядке names.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    names = shard_studies(names, shard_index, shard_count)
+
+    # Результаты хранятся по полному пути исследования: повторы в списке иначе перезаписали бы друг друга
+    keys = [study_key(directory_path, name) for name in names]
+    counts = Counter(keys)
+    duplicates = sorted({name for name, key in zip(names, keys) if counts[key] > 1}, key=str)
+    if duplicates:
+        raise ValueError(f"Исследования указаны несколько раз: {duplicates}")
+
+    # Отчеты разных узлов не должны перезаписывать друг друга
+    report_suffix = ""
+    if use_queue:
+        report_suffix = f"_{socket.gethostname()}_{os.getpid()}"
+    elif shard_count > 1:
+        report_suffix = f"_shard{shard_index}"
+    if summary_path is None:
+        summary_path = os.path.join(directory_path, f"study_summary{report_suffix}.csv")
+
+    queue = None
+    if use_queue:
+        queue = {"queue_dir": queue_dir or os.path.join(directory_path, QUEUE_DIR_NAME), "stale_after": stale_after,
+                 "retry_failed": retry_failed}
+
+    total = len(names)
+    results = {}
+
+    def report(result):
+        results[study_key(directory_path, result["study"])] = result
+        logger.info("run_studies: [%d/%d] исследование %s: %s за %s с", len(results), total, result["study"],
+                    result["status"], result["time"])
+
+    if workers == 1:
+        for name in names:
+            report(process_study(directory_path, name, study_options, name == cprofile_study, queue))
+    else:
+        # Записи процессов пула попадают в файл журнала через очередь основного процесса
+        log_queue, listener = start_log_listener(log_file) if log_file is not None else (None, None)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=setup_logging,
+                                     initargs=(log_level, quiet, None, log_queue)) as executor:
+                futures = {
+                    executor.submit(process_study, directory_path, name, study_options, name == cprofile_study,
+                                    queue): name
+                    for name in names
+                }
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception:
+                        # Процесс-обработчик аварийно завершился (например, из-за падения нативной библиотеки)
+                        result = {"study": futures[future], "status": "error", "time": 0.0,
+                                  "error": traceback.format_exc(), "file_errors": [], "stages": {}}
+                        if queue is not None:
+                            finish_study(queue["queue_dir"], result["study"], result)
+                    report(result)
+        finally:
+            if listener is not None:
+                listener.stop()
+                for handler in listener.handlers:
+                    handler.close()
+
+    results = [results[key] for key in keys]
+    save_summary(results, summary_path)
+
+    report_dir = os.path.dirname(os.path.abspath(summary_path))
+    save_stage_report([{"study": result["study"], "stages": result["stages"]} for result in results],
+                      json_path=os.path.join(report_dir, f"stage_report{report_suffix}.json"),
+                      csv_path=os.path.join(report_dir, f"stage_report{report_suffix}.csv"))
+    save_error_report(results, os.path.join(report_dir, f"error_report{report_suffix}.json"))
+
+    # Файлы исследований объединяются в одно хранилище после завершения всех процессов
+    # (при нескольких узлах - все готовые файлы исследований, последний узел собирает полное хранилище)
+    if study_options.get("output_format") == 'hdf5':
+        if use_queue or shard_count > 1:
+            consolidate_store(directory_path)
+        else:
+            consolidate_store(directory_path,
+                              [result["study"] for result in results if result["status"] != "error"])
+
+    failed = [result["study"] for result in results if result["status"] == "error"]
+    if failed:
+        logger.error("run_studies: ошибки в исследованиях %s, подробности в %s", failed, summary_path)
+
+    return results
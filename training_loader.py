@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from build_cache import CACHE_DIR_NAME, output_state
+from atomic_io import atomic_write_path
+from slice_index import natural_sort_key
+from sparse_labels import rle_path, load_rle, tumour_slices as rle_tumour_slices
+import threading
+import logging
+import nibabel as nib
+import numpy as np
+import queue
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+TUMOUR_INDEX_NAME = "tumour_index.json"
+
+# Признак конца потока в очереди предвыборки
+_END = object()
+
+
+def find_study_pairs(directory_path):
+    """
+    Находит пары NIfTI-файлов (снимки, разметка), созданные create_nifty_data:
+    <directory_path>/images/<номер>_image.nii[.gz] и <directory_path>/labels/<номер>_label.nii[.gz].
+
+    :param directory_path: Директория набора данных.
+    :return: Список кортежей (номер исследования, путь к снимкам, путь к разметке) в порядке номеров.
+    """
+    images_dir = os.path.join(directory_path, "images")
+    labels_dir = os.path.join(directory_path, "labels")
+
+    labels = {}
+    for file_name in os.listdir(labels_dir):
+        study, _, suffix = file_name.partition("_label")
+        if suffix in (".nii", ".nii.gz"):
+            labels[study] = os.path.join(labels_dir, file_name)
+
+    pairs = []
+    for file_name in sorted(os.listdir(images_dir), key=natural_sort_key):
+        study, _, suffix = file_name.partition("_image")
+        if suffix in (".nii", ".nii.gz") and study in labels:
+            pairs.append((study, os.path.join(images_dir, file_name), labels[study]))
+    return pairs
+
+
+def tumour_slices(label_path):
+    """
+    Возвращает номера срезов, на которых есть ненулевые воксели разметки.
+    Разметка читается по одному срезу через dataobj, весь объем в память не загружается.
+
+    Если рядом с разметкой есть разреженная разметка (sparse_labels) не старше NIfTI-файла, срезы берутся из нее
+    без чтения объема.
+
+    :param label_path: Путь к NIfTI-файлу разметки (H, W, количество срезов).
+    :return: Форма объема и список номеров срезов с опухолью.
+    """
+    sparse_path = rle_path(label_path)
+    if os.path.exists(sparse_path) and os.path.getmtime(sparse_path) >= os.path.getmtime(label_path):
+        rle = load_rle(sparse_path)
+        num_slices, height, width = (int(v) for v in rle["shape"])
+        return (height, width, num_slices), [int(z) for z in rle_tumour_slices(rle)]
+
+    proxy = nib.load(label_path).dataobj
+    slices = [z for z in range(proxy.shape[2]) if np.any(np.asarray(proxy[:, :, z]))]
+    return tuple(int(v) for v in proxy.shape[:3]), slices
+
+
+def build_tumour_index(directory_path, pairs=None):
+    """
+    Строит (или загружает из <directory_path>/.cache/tumour_index.json) индекс срезов с опухолью по исследованиям.
+    Запись исследования пересчитывается только при изменении файла разметки.
+
+    :param directory_path: Директория набора данных.
+    :param pairs: Пары файлов (find_study_pairs); по умолчанию ищутся в directory_path.
+    :return: Словарь {номер исследования: {"image", "label", "shape", "tumour_slices"}}.
+    """
+    if pairs is None:
+        pairs = find_study_pairs(directory_path)
+
+    index_path = os.path.join(directory_path, CACHE_DIR_NAME, TUMOUR_INDEX_NAME)
+    cached = {}
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+
+    index, changed = {}, False
+    for study, image_path, label_path in pairs:
+        state = output_state(label_path)
+        entry = cached.get(study)
+        if entry is None or entry.get("label") != label_path or entry.get("label_state") != state:
+            shape, slices = tumour_slices(label_path)
+            entry = {"image": image_path, "label": label_path, "label_state": state, "shape": shape,
+                     "tumour_slices": slices}
+            changed = True
+            logger.debug("индекс опухоли: исследование %s, срезов с опухолью %d из %d", study, len(slices),
+                         shape[2])
+        entry["image"] = image_path
+        index[study] = entry
+
+    if changed or set(index) != set(cached):
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        # Атомарная замена: параллельные загрузчики не прочитают недописанный индекс
+        with atomic_write_path(index_path) as tmp_path:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(index, f, ensure_ascii=False, indent=2)
+
+    return index
+
+
+def sample_patch_origins(index, num_patches, patch_size, tumour_fraction=0.5, seed=None):
+    """
+    Выбирает положения патчей. С вероятностью tumour_fraction патч центрируется на случайном срезе с опухолью,
+    иначе выбирается случайный срез исследования.
+
+    :param index: Индекс исследований (build_tumour_index).
+    :param num_patches: Количество патчей.
+    :param patch_size: Размер патча (H, W) для 2D или (H, W, D) для 3D.
+    :param tumour_fraction: Доля патчей, содержащих срез с опухолью.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Генератор кортежей (номер исследования, (y0, x0, z0)).
+    """
+    rng = np.random.default_rng(seed)
+    studies = sorted(index, key=natural_sort_key)
+    tumour_studies = [study for study in studies if index[study]["tumour_slices"]]
+    depth = patch_size[2] if len(patch_size) == 3 else 1
+
+    for _ in range(num_patches):
+        if tumour_studies and rng.random() < tumour_fraction:
+            study = tumour_studies[rng.integers(len(tumour_studies))]
+            slices = index[study]["tumour_slices"]
+            centre = slices[rng.integers(len(slices))]
+        else:
+            study = studies[rng.integers(len(studies))]
+            centre = int(rng.integers(index[study]["shape"][2]))
+
+        height, width, num_slices = index[study]["shape"]
+        z0 = int(np.clip(centre - depth // 2, 0, max(num_slices - depth, 0)))
+        y0 = int(rng.integers(max(height - patch_size[0], 0) + 1))
+        x0 = int(rng.integers(max(width - patch_size[1], 0) + 1))
+        yield study, (y0, x0, z0)
+
+
+def read_patch(image_path, label_path, origin, patch_size):
+    """
+    Читает патч снимков и разметки через dataobj NIfTI (для несжатых .nii - через отображение в память).
+    Патчи на границе объема дополняются нулями до patch_size.
+
+    :param image_path: Путь к NIfTI-файлу снимков.
+    :param label_path: Путь к NIfTI-файлу разметки.
+    :param origin: Начало патча (y0, x0, z0).
+    :param patch_size: Размер патча (H, W) для 2D или (H, W, D) для 3D.
+    :return: Патч снимков и бинарный патч разметки (uint8, 0/1) формы patch_size.
+    """
+    y0, x0, z0 = origin
+    depth = patch_size[2] if len(patch_size) == 3 else 1
+    region = (slice(y0, y0 + patch_size[0]), slice(x0, x0 + patch_size[1]), slice(z0, z0 + depth))
+
+    patches = []
+    for path in (image_path, label_path):
+        data = np.asarray(nib.load(path).dataobj[region])
+        if data.shape != (patch_size[0], patch_size[1], depth):
+            padded = np.zeros((patch_size[0], patch_size[1], depth), dtype=data.dtype)
+            padded[:data.shape[0], :data.shape[1], :data.shape[2]] = data
+            data = padded
+        patches.append(data if len(patch_size) == 3 else data[:, :, 0])
+
+    image, label = patches
+    return image, (label > 0).astype(np.uint8)
+
+
+def read_batch(jobs, patch_size):
+    """
+    Читает пакет патчей.
+
+    :param jobs: Список кортежей (путь к снимкам, путь к разметке, начало патча).
+    :param patch_size: Размер патча.
+    :return: Массивы снимков и разметки формы (размер пакета, *patch_size).
+    """
+    patches = [read_patch(image_path, label_path, origin, patch_size) for image_path, label_path, origin in jobs]
+    return np.stack([image for image, _ in patches]), np.stack([label for _, label in patches])
+
+
+def stream_patches(directory_path, num_patches, patch_size=(512, 512), batch_size=16, tumour_fraction=0.5,
+                   workers=4, use_processes=False, queue_depth=8, seed=None):
+    """
+    Потоково выдает пакеты 2D-срезов или 3D-патчей из NIfTI-файлов набора данных без загрузки объемов целиком.
+    Пакеты читаются пулом потоков (или процессов) с ограниченной очередью предвыборки:
+    в памяти одновременно находится не более queue_depth пакетов.
+
+    :param directory_path: Директория набора данных (с поддиректориями images и labels).
+    :param num_patches: Общее количество патчей.
+    :param patch_size: Размер патча (H, W) - срезы, (H, W, D) - 3D-патчи.
+    :param batch_size: Размер пакета.
+    :param tumour_fraction: Доля патчей, центрированных на срезах с опухолью.
+    :param workers: Количество потоков/процессов чтения.
+    :param use_processes: Использовать пул процессов вместо пула потоков.
+    :param queue_depth: Максимальное количество пакетов в очереди предвыборки.
+    :param seed: Начальное значение генератора случайных чисел.
+    :return: Генератор пар (снимки, разметка) формы (размер пакета, *patch_size).
+    """
+    patch_size = tuple(int(v) for v in patch_size)
+    index = build_tumour_index(directory_path)
+    if not index:
+        raise ValueError(f"В {directory_path} нет пар NIfTI-файлов images/labels!")
+
+    origins = sample_patch_origins(index, num_patches, patch_size, tumour_fraction, seed)
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    prefetch = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                prefetch.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(executor):
+        try:
+            jobs = []
+            for study, origin in origins:
+                jobs.append((index[study]["image"], index[study]["label"], origin))
+                if len(jobs) == batch_size:
+                    if not put(executor.submit(read_batch, jobs, patch_size)):
+                        return
+                    jobs = []
+            if jobs:
+                put(executor.submit(read_batch, jobs, patch_size))
+        except Exception as error:
+            # Ошибка передается потребителю, иначе поток пакетов молча оборвался бы
+            put(error)
+        finally:
+            put(_END)
+
+    with executor_class(max_workers=workers) as executor:
+        producer = threading.Thread(target=produce, args=(executor,), daemon=True)
+        producer.start()
+        try:
+            while True:
+                future = prefetch.get()
+                if future is _END:
+                    break
+                if isinstance(future, Exception):
+                    raise future
+                yield future.result()
+        finally:
+            stop.set()
+            producer.join()
@@ -0,0 +1,127 @@
+from functools import lru_cache
+import numpy as np
+
+# Предустановленные окна КТ: (центр, ширина) в HU
+WINDOW_PRESETS = {
+    'soft_tissue': (10, 350),  # Мягкие ткани (как в dicom_to_png_array)
+    'lung': (-600, 1500),  # Легкие
+    'bone': (400, 1800),  # Кости
+    'mediastinum': (50, 350),  # Средостение
+}
+
+
+def resolve_window(window):
+    """
+    Возвращает (центр, ширина) окна по имени предустановки или по самому кортежу.
+
+    :param window: Имя из WINDOW_PRESETS или кортеж (центр, ширина).
+    """
+    if isinstance(window, str):
+        if window not in WINDOW_PRESETS:
+            raise KeyError(f"Неизвестное окно {window}, доступны: {list(WINDOW_PRESETS)}")
+        return WINDOW_PRESETS[window]
+    center, width = window
+    return center, width
+
+
+def apply_window(volume, center, width):
+    """
+    Применяет окно к массиву значений HU любой формы (срез или объем Z×H×W) за один векторный проход.
+    Вычисления выполняются во float32.
+
+    :param volume: Массив значений HU.
+    :param center: Центр окна.
+    :param width: Ширина окна.
+    :return: Массив uint8 той же формы.
+    """
+    img_min = np.float32(center - width / 2)
+    img_max = np.float32(center + width / 2)
+
+    windowed = np.clip(np.asarray(volume, dtype=np.float32), img_min, img_max)
+    windowed -= img_min
+    windowed /= img_max - img_min
+    windowed *= np.float32(255)
+    return windowed.astype(np.uint8)
+
+
+@lru_cache(maxsize=32)
+def build_window_lut(center, width, slope=1.0, intercept=0.0, dtype='<i2'):
+    """
+    Строит таблицу соответствия "хранимое значение пикселя -> значение окна" для целочисленных данных
+    (не более 16 бит). Рескейлинг DICOM (slope, intercept) учитывается в самой таблице.
+
+    :param center: Центр окна.
+    :param width: Ширина окна.
+    :param slope: RescaleSlope.
+    :param intercept: RescaleIntercept.
+    :param dtype: Тип хранимых значений (строка numpy dtype).
+    :return: Массив uint8 длины 2 ** (8 * itemsize), индекс - значение минус минимум типа.
+    """
+    info = np.iinfo(np.dtype(dtype))
+    values = np.arange(info.min, info.max + 1, dtype=np.float32)
+    values *= np.float32(slope)
+    values += np.float32(intercept)
+    lut = apply_window(values, center, width)
+    lut.flags.writeable = False
+    return lut
+
+
+def lut_index(volume):
+    """
+    Переводит целочисленный массив в индексы таблицы build_window_lut (значение минус минимум типа)
+    без перехода к более широкому типу.
+    """
+    if volume.dtype.kind == 'u':
+        return volume
+    unsigned = volume.view(np.dtype(f'u{volume.dtype.itemsize}'))
+    return unsigned ^ unsigned.dtype.type(1 << (8 * volume.dtype.itemsize - 1))
+
+
+def apply_windows(volume, windows=None, slope=1.0, intercept=0.0):
+    """
+    Вычисляет несколько окон за одно чтение данных объема.
+    Для целочисленных данных (до 16 бит) и скалярного рескейлинга используется таблица соответствия,
+    иначе - один переход к HU во float32 для всех окон.
+
+    :param volume: Объем (Z×H×W или H×W×Z) хранимых значений или значений HU.
+    :param windows: Список имен/кортежей окон или словарь {имя: (центр, ширина)}; по умолчанию все WINDOW_PRESETS.
+    :param slope: RescaleSlope (скаляр или массив, транслируемый на объем).
+    :param intercept: RescaleIntercept (скаляр или массив, транслируемый на объем).
+    :return: Словарь {имя окна: массив uint8 той же формы}.
+    """
+    if windows is None:
+        windows = WINDOW_PRESETS
+    if not isinstance(windows, dict):
+        windows = {(w if isinstance(w, str) else f"{w[0]}_{w[1]}"): w for w in windows}
+    windows = {name: resolve_window(window) for name, window in windows.items()}
+
+    volume = np.asarray(volume)
+    use_lut = volume.dtype.kind in 'iu' and volume.dtype.itemsize <= 2 and np.ndim(slope) == 0 \
+        and np.ndim(intercept) == 0
+
+    result = {}
+    if use_lut:
+        index = lut_index(volume)
+        for name, (center, width) in windows.items():
+            lut = build_window_lut(center, width, float(slope), float(intercept), volume.dtype.str)
+            result[name] = lut[index]
+    else:
+        hu = volume.astype(np.float32)
+        if np.ndim(slope) != 0 or slope != 1:
+            hu *= np.asarray(slope, dtype=np.float32)
+        if np.ndim(intercept) != 0 or intercept != 0:
+            hu += np.asarray(intercept, dtype=np.float32)
+        for name, (center, width) in windows.items():
+            result[name] = apply_window(hu, center, width)
+
+    return result
+
+
+def stack_windows(volume, windows=None, slope=1.0, intercept=0.0):
+    """
+    Возвращает окна как каналы одного массива (последняя ось) - в таком виде их получает модель.
+
+    :return: Массив uint8 формы volume.shape + (количество окон,).
+    """
+    windowed = apply_windows(volume, windows, slope, intercept)
+    return np.stack(list(windowed.values()), axis=-1)
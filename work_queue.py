@@ -0,0 +1,160 @@
+from atomic_io import atomic_write_path
+import zlib
+import socket
+import uuid
+import json
+import time
+import os
+
+QUEUE_DIR_NAME = ".queue"
+
+
+def shard_studies(studies, shard_index=0, shard_count=1):
+    """
+    Выбирает исследования шарда: исследование относится к шарду номер % shard_count
+    (для нечисловых номеров - crc32(номер) % shard_count).
+    Распределение не зависит от порядка и состава списка на разных узлах.
+
+    :param studies: Список номеров исследований.
+    :param shard_index: Номер шарда (с 0).
+    :param shard_count: Количество шардов.
+    :return: Список номеров исследований шарда в исходном порядке.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Номер шарда {shard_index} вне диапазона [0, {shard_count})")
+
+    def shard(study):
+        study = str(study)
+        return int(study) if study.isdigit() else zlib.crc32(study.encode("utf-8"))
+
+    return [study for study in studies if shard(study) % shard_count == shard_index]
+
+
+def marker_path(queue_dir, study, kind):
+    """
+    Путь к файлу очереди исследования: <queue_dir>/<номер>.<kind> (lock, done или error).
+    """
+    return os.path.join(queue_dir, f"{study}.{kind}")
+
+
+def node_info():
+    """
+    Сведения об узле и процессе для файлов очереди.
+    """
+    return {"host": socket.gethostname(), "pid": os.getpid(), "time": time.time()}
+
+
+def _finished_state(queue_dir, study, retry_failed):
+    """
+    Состояние завершенного исследования по маркерам очереди: 'done', 'failed' или None.
+    """
+    if os.path.exists(marker_path(queue_dir, study, "done")):
+        return "done"
+    if os.path.exists(marker_path(queue_dir, study, "error")) and not retry_failed:
+        return "failed"
+    return None
+
+
+def _read_lock(lock_path):
+    """
+    Содержимое файла блокировки (None, если файла нет).
+    """
+    try:
+        with open(lock_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def claim_study(queue_dir, study, stale_after=None, retry_failed=False):
+    """
+    Захватывает исследование в очереди на общей файловой системе: файл блокировки создается
+    атомарно (O_CREAT | O_EXCL), поэтому исследование получает ровно один узел.
+    Оставленная блокировка снимается переименованием под уникальным именем узла; владение подтверждается
+    сравнением содержимого с блокировкой, признанной устаревшей.
+
+    :param queue_dir: Директория очереди (общая для всех узлов).
+    :param study: Номер исследования.
+    :param stale_after: Через сколько секунд блокировка считается оставленной упавшим узлом и снимается
+        (None - блокировки не снимаются).
+    :param retry_failed: Повторно обрабатывать исследования, завершившиеся ошибкой.
+    :return: 'claimed' - исследование захвачено, 'done' - уже обработано, 'failed' - завершилось ошибкой,
+        'busy' - обрабатывается другим узлом.
+    """
+    os.makedirs(queue_dir, exist_ok=True)
+    state = _finished_state(queue_dir, study, retry_failed)
+    if state is not None:
+        return state
+
+    lock_path = marker_path(queue_dir, study, "lock")
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if stale_after is None:
+                return "busy"
+            content = _read_lock(lock_path)
+            try:
+                age = time.time() - os.path.getmtime(lock_path)
+            except OSError:
+                continue  # Блокировку только что сняли - пробуем еще раз
+            if content is None or age < stale_after:
+                return "busy"
+            # Оставленная блокировка переименовывается атомарно под уникальным именем узла: переименование
+            # одного файла удается только одному узлу. Затем содержимое читается обратно: если оно отличается
+            # от блокировки, признанной устаревшей, между проверкой и переименованием блокировку уже заменил
+            # другой узел - она возвращается на место (os.link не перезаписывает существующий файл).
+            info = node_info()
+            stale_path = f"{lock_path}.stale-{info['host']}-{info['pid']}"
+            try:
+                os.rename(lock_path, stale_path)
+            except OSError:
+                continue  # Блокировку уже снял или захватил другой узел
+            if _read_lock(stale_path) != content:
+                try:
+                    os.link(stale_path, lock_path)
+                except OSError:
+                    pass
+                os.remove(stale_path)
+                return "busy"
+            os.remove(stale_path)
+            continue
+
+        # Уникальный токен: содержимое каждой блокировки отличается, даже если узел и время совпадают
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(dict(node_info(), token=uuid.uuid4().hex), f)
+
+        # Между проверкой маркеров и созданием блокировки другой узел мог завершить исследование
+        # и снять свою блокировку - тогда захват отменяется
+        state = _finished_state(queue_dir, study, retry_failed)
+        if state is not None:
+            os.remove(lock_path)
+            return state
+        return "claimed"
+
+    return "busy"
+
+
+def finish_study(queue_dir, study, result):
+    """
+    Записывает маркер завершения исследования (done или error) и снимает блокировку.
+
+    :param queue_dir: Директория очереди.
+    :param study: Номер исследования.
+    :param result: Запись о результате (process_study); статус 'error' дает маркер error.
+    """
+    kind = "error" if result["status"] == "error" else "done"
+    marker = dict(node_info(), status=result["status"], time_spent=result["time"], error=result["error"])
+
+    with atomic_write_path(marker_path(queue_dir, study, kind)) as tmp_path:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(marker, f, ensure_ascii=False, indent=2)
+
+    # Успешная повторная обработка снимает маркер ошибки
+    if kind == "done" and os.path.exists(marker_path(queue_dir, study, "error")):
+        os.remove(marker_path(queue_dir, study, "error"))
+
+    try:
+        os.remove(marker_path(queue_dir, study, "lock"))
+    except FileNotFoundError:
+        pass